@@ -1,6 +1,13 @@
 from datetime import datetime, timedelta
+import hashlib
+import pathlib
+import shutil
+import uuid
 import polars as pl
 from data_analyzer import DataAnalyzer
+from dataset_registry import Dataset, DatasetRegistry
+from dataset_store import DatasetStore
+from profiling import Profiler, stage
 import streamlit as st
 from dictionaries import location_names
 
@@ -18,8 +25,51 @@ def initialize_state():
         st.session_state.analyzer_L = None
     if "analyzer_total" not in st.session_state:
         st.session_state.analyzer_total = None
+    if "dataset_view" not in st.session_state:
+        st.session_state.dataset_view = None
     if "locations" not in st.session_state:
         st.session_state.locations = []
+    if "profiler" not in st.session_state:
+        st.session_state.profiler = Profiler()
+
+
+def choose_downsampling():
+    methods = {'Min/max': 'minmax', 'LTTB': 'lttb'}
+    selected_method = st.sidebar.radio('Line chart downsampling', list(methods))
+    st.session_state.downsampling = methods[selected_method]
+
+
+# WebGL charts send their values as binary arrays, the legacy renderer is st.line_chart
+def choose_renderer():
+    renderers = {'WebGL': 'webgl', 'Legacy': 'legacy'}
+    selected_renderer = st.sidebar.radio('Line chart renderer', list(renderers))
+    st.session_state.renderer = renderers[selected_renderer]
+
+
+# Profiling is opt-in, every rerun starts with an empty profile
+def choose_profiling():
+    st.session_state.profiling = st.sidebar.checkbox('Profiler')
+    st.session_state.profiler.reset()
+
+
+# Shows the stages of this rerun in the sidebar with JSON and Prometheus exports
+def show_profiler():
+    profiler = st.session_state.profiler
+    if not st.session_state.profiling:
+        return
+
+    st.sidebar.write('<h3>Profiler</h3>', unsafe_allow_html=True)
+    if not profiler.records:
+        st.sidebar.write('No stages were run')
+        return
+
+    top_level = [record for record in profiler.records if '/' not in record.stage]
+    st.sidebar.write(f'Total: {sum(record.seconds for record in top_level):.3f} s')
+    st.sidebar.dataframe(pl.DataFrame([record.as_dict() for record in profiler.records]), hide_index=True)
+    st.sidebar.download_button(label='Download profile as JSON', data=profiler.to_json(),
+                               file_name='profile.json', mime='application/json')
+    st.sidebar.download_button(label='Download profile as Prometheus text', data=profiler.to_prometheus(),
+                               file_name='profile.prom', mime='text/plain')
 
 
 def choose_dataframe():
@@ -30,17 +80,18 @@ def choose_dataframe():
 
 def show_options():
     options = ['', 'List columns', 'Sample', 'Describe', 'SQL query', 'Line chart', 'Heatmap', 'Net Expenses',
-               'Cost-effectiveness']
+               'Cost-effectiveness', 'Expense report', 'Data availability']
     selected_option = st.radio('Select Action', list(options))
     return selected_option
 
 
 def choose_location():
-    location_display_names = [location_names[key] for key in st.session_state.locations]
+    # Meters that are not in location_names are shown by their meter_id
+    location_display_names = [location_names.get(key, key) for key in st.session_state.locations]
     selected_display_name = st.selectbox('Select Location', location_display_names)
 
     # Create a dictionary to map display names back to keys
-    display_name_to_key = {v: k for k, v in location_names.items()}
+    display_name_to_key = {location_names.get(key, key): key for key in st.session_state.locations}
     selected_location = display_name_to_key[selected_display_name]
     return selected_location
 
@@ -112,67 +163,176 @@ def choose_time_interval():
     return start, end
 
 
-# Function to read large parquet file
+# Content hash of the uploaded file, which identifies it in the store and the registry
 @st.cache_data
-def scan_large_parquet(file):
-    df_scan = pl.read_parquet(file)
-    return df_scan
+def upload_fingerprint(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Function to write the uploaded file to disk so it can be scanned lazily. Returns the path of the file.
+# Every call writes a file of its own, which the caller removes when it's done with it
+def spool_upload(file):
+    dirpath = pathlib.Path('./upload_files/')
+    dirpath.mkdir(exist_ok=True)
+    path = dirpath / f'{uuid.uuid4().hex}.parquet'
+    file.seek(0)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(file, f, 1024 * 1024)
+    return path
+
+
+# Datasets are shared by all sessions, so the same file uploaded in several sessions is held in memory once
+@st.cache_resource
+def get_dataset_registry():
+    return DatasetRegistry(memory_budget=2 * 1024 * 1024 * 1024)  # 2 GB
+
+
+# Processed datasets are stored on disk, so they can be opened again after a restart without uploading them
+@st.cache_resource
+def get_dataset_store():
+    return DatasetStore('./datasets/')
+
+
+# Processes the spooled file into a new stored dataset and returns its name
+def ingest_upload(path, fingerprint, file_name):
+    store = get_dataset_store()
+    progress_bar = st.progress(0.0, text='Processing the file...')
+
+    def show_progress(done, total):
+        progress_bar.progress(done / total, text=f'Processing row group {done} / {total}')
+
+    with stage('ingest_parquet'):
+        manifest = store.ingest(store.unique_name(file_name), path, fingerprint, file_name, show_progress)
+    progress_bar.empty()
+
+    for name, dataset in manifest['datasets'].items():
+        st.write(f'{name} values in memory: {dataset["memory_before"] / 1024 ** 2:.1f} MB, '
+                 f'{dataset["memory_after"] / 1024 ** 2:.1f} MB with compact column types')
+    return manifest['name']
+
+
+# Opens a stored dataset. Only its manifest, hourly rollups and gap indexes are read,
+# the partitions are lazy scans and nothing is read from them until a chart collects them
+def build_dataset(name):
+    store = get_dataset_store()
+    manifest = store.read_manifest(name)
+    with st.spinner('Building hourly and daily tables...'), stage('build_analyzers'):
+        analyzer_L = DataAnalyzer(store.scan(manifest, 'L'), 'L', manifest['fingerprint'],
+                                  store.hourly_rollup(manifest, 'L'), store.gap_index(manifest, 'L'))
+        analyzer_total = DataAnalyzer(store.scan(manifest, 'Total'), 'Total', manifest['fingerprint'],
+                                      store.hourly_rollup(manifest, 'Total'), store.gap_index(manifest, 'Total'))
+    locations = analyzer_total.hourly_rollup['meter_id'].unique().to_list()
+    return Dataset(manifest['fingerprint'], analyzer_L, analyzer_total, locations)
+
+
+# Returns a view of the dataset the uploaded file was stored as, processing the file if it wasn't stored before.
+# The dataset is opened by its name, so a file that was appended to after it was stored opens the current dataset
+def open_upload(uploaded_file):
+    with st.spinner('Reading the file...'), stage('hash_upload'):
+        fingerprint = upload_fingerprint(uploaded_file)
+
+    store = get_dataset_store()
+    with store.ingest_lock(fingerprint):
+        name = store.find(fingerprint)
+        if name is None:
+            # Write the file to disk, then process it one row group at a time
+            with stage('spool_upload'):
+                path = spool_upload(uploaded_file)
+            try:
+                name = ingest_upload(path, fingerprint, uploaded_file.name)
+            finally:
+                path.unlink(missing_ok=True)
+    return open_stored_dataset(name)
+
+
+# Appends the uploaded export to a stored dataset. Only the new rows are processed
+def append_upload(name, uploaded_file):
+    store = get_dataset_store()
+    with st.spinner('Reading the file...'), stage('hash_upload'):
+        fingerprint = upload_fingerprint(uploaded_file)
+    if any(source['fingerprint'] == fingerprint for source in store.read_manifest(name)['sources']):
+        st.write(f'{uploaded_file.name} is already in {name}')
+        return
+
+    with stage('spool_upload'):
+        path = spool_upload(uploaded_file)
+    progress_bar = st.progress(0.0, text='Appending the file...')
+
+    def show_progress(done, total):
+        progress_bar.progress(done / total, text=f'Appending row group {done} / {total}')
+
+    try:
+        with stage('append_parquet'):
+            _, rows_added = store.append(name, path, fingerprint, uploaded_file.name, show_progress)
+    except ValueError as error:
+        st.error(str(error))
+        return
+    finally:
+        progress_bar.empty()
+        path.unlink(missing_ok=True)
+    st.write(f'{rows_added} new rows appended to {name}')
+
+
+def open_stored_dataset(name):
+    manifest = get_dataset_store().read_manifest(name)
+    with stage('build_dataset'):
+        return get_dataset_registry().acquire(manifest['fingerprint'], lambda: build_dataset(name))
 
 
 st.set_page_config(layout="wide")
 initialize_state()
+choose_downsampling()
+choose_renderer()
+choose_profiling()
 
 if st.session_state.analyzer_L is None and st.session_state.analyzer_total is None:
+    dataset_view = None
+
+    # Datasets that were processed before
+    stored_names = get_dataset_store().names()
+    if stored_names:
+        st.write('<h3>Open a stored dataset</h3>', unsafe_allow_html=True)
+        stored_name = st.selectbox('Select Dataset', [''] + stored_names)
+        if stored_name:
+            # A new export of the same meters can be appended before the dataset is opened
+            appended_file = st.file_uploader("Append a new export to the dataset", type=["parquet"],
+                                             key='append_file')
+            if appended_file is not None:
+                append_upload(stored_name, appended_file)
+            dataset_view = open_stored_dataset(stored_name)
+
     # File uploader for parquet file
     st.write('<h3>Place your parquet file here</h3>', unsafe_allow_html=True)
     uploaded_file = st.file_uploader("Choose a file", type=["parquet"])
 
-    if uploaded_file is not None:
+    if uploaded_file is not None and dataset_view is None:
         # Display file details
         st.write("Filename:", uploaded_file.name)
         st.write("File size:", uploaded_file.size, "bytes")
 
-        # Read and process the file
-        with st.spinner('Reading the file...'):
-            df_all = scan_large_parquet(uploaded_file)
-
+        dataset_view = open_upload(uploaded_file)
         st.success('File successfully read!')
 
-        total_columns = []
-        data_columns = []
-        for col in df_all.columns:
-            if 'total' in col or 'Total' in col:
-                total_columns.append(col)
-            elif 'ts' not in col and 'meter_id' not in col and 'price' not in col:
-                data_columns.append(col)
-
-        # Remove negative prices
-        df_all = df_all.with_columns(
-            pl.when(pl.col('price') < 0)
-            .then(0)
-            .otherwise(pl.col('price'))
-            .alias('price')
-        )
-
-        # Create df_L1_L2_L3 and df_total dataframes
-        df_L1_L2_L3 = df_all.drop(total_columns)
-        df_L1_L2_L3 = df_L1_L2_L3.rename({col: col.replace(' ', '_').lower() for col in df_L1_L2_L3.columns})
-        df_total = df_all.drop(data_columns)
-        df_total = df_total.rename({col: col.replace(' ', '_').lower() for col in df_total.columns})
-
-        # Prices are in EUR / MWh and total_active_power is in W, so divide by 1 000 000 to get EUR / h
-        df_total = df_total.with_columns(
-            ((pl.col('total_active_power') * pl.col('price'))/1000000).alias('expenses'))
-
-        st.session_state.analyzer_L = DataAnalyzer(df_L1_L2_L3, 'L')
-        st.session_state.analyzer_total = DataAnalyzer(df_total, 'Total')
-
-        st.write('<h3>L1, L2, L3 values:</h3>', unsafe_allow_html=True)
-        st.write(df_L1_L2_L3.head())
-        st.write('<h3>Total values:</h3>', unsafe_allow_html=True)
-        st.write(df_total.head())
-
-        st.session_state.locations = df_all.select(pl.col('meter_id')).unique()['meter_id'].to_list()
+    if dataset_view is not None:
+
+        # The session keeps only a view of the shared dataset
+        st.session_state.dataset_view = dataset_view
+        st.session_state.analyzer_L = dataset_view.analyzer_L
+        st.session_state.analyzer_total = dataset_view.analyzer_total
+        df_L1_L2_L3 = dataset_view.analyzer_L.dataframe
+        df_total = dataset_view.analyzer_total.dataframe
+
+        with stage('preview'):
+            st.write('<h3>L1, L2, L3 values:</h3>', unsafe_allow_html=True)
+            st.write(df_L1_L2_L3.head().collect())
+            st.write('<h3>Total values:</h3>', unsafe_allow_html=True)
+            st.write(df_total.head().collect())
+
+        st.session_state.locations = dataset_view.locations
         chosen_dataframe = choose_dataframe()
 else:
     chosen_dataframe = choose_dataframe()
@@ -202,7 +362,9 @@ else:
             st.write(analyzer.show_sample())
         if action == 'Describe':
             st.write("<h3>Summary statistics of the DataFrame:</h3>", unsafe_allow_html=True)
-            st.write(analyzer.describe_dataframe())
+            by_meter = st.checkbox('Statistics of each meter')
+            st.write('The quartiles are approximate.')
+            st.write(analyzer.describe_dataframe(by_meter))
         if action == 'SQL query':
             analyzer.query_with_sql()
         if action == 'Line chart':
@@ -227,3 +389,12 @@ else:
             else:
                 start_time, end_time = choose_time_interval()
                 analyzer.cost_effectiveness(start_time, end_time)
+        if action == 'Expense report':
+            if chosen_dataframe == 'L1, L2, L3 values':
+                st.write('Expense report not available for this dataframe')
+            else:
+                analyzer.expense_report()
+        if action == 'Data availability':
+            analyzer.data_availability()
+
+show_profiler()
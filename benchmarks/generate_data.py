@@ -0,0 +1,113 @@
+import argparse
+import pathlib
+import sys
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from dictionaries import location_names
+
+START = np.datetime64('2024-01-01T00:00:00', 's')
+INTERVAL_SECONDS = 10  # The meters report every 10 seconds
+STEPS_PER_ROW_GROUP = 40000  # 1 000 000 rows per row group with 25 meters
+SOLAR_METER = 's-c8f09e8316e0'  # Aurinkovoimala, produces power during the day
+PHASES = ['L1', 'L2', 'L3']
+
+
+# Hourly electricity price in EUR / MWh. It is the same for every meter and is negative on some sunny afternoons
+def hourly_price(hours):
+    hour_of_day = hours % 24
+    daily = 45 + 35 * np.sin(2 * np.pi * (hour_of_day - 8) / 24)
+    weekly = 25 * np.sin(2 * np.pi * hours / (24 * 7))
+    return np.round(daily + weekly + 15 * np.sin(hours * 0.37), 2)
+
+
+# Returns one chunk of meter data in the schema of the uploaded files, ordered by ts like the meter logs.
+# energy holds the energy counters of every meter and is updated so the counters keep growing between chunks
+def generate_chunk(rng, first_step, n_steps, meters, energy):
+    n_meters = len(meters)
+    steps = np.arange(first_step, first_step + n_steps)
+    hours = steps * INTERVAL_SECONDS // 3600
+    hour_of_day = (hours % 24)[:, None]
+
+    # Load follows the time of day, every meter has its own base load
+    meter_scale = np.linspace(200, 3000, n_meters)[None, :]
+    load = meter_scale * (1 + 0.5 * np.sin(2 * np.pi * (hour_of_day - 6) / 24))
+    solar = np.array([meter == SOLAR_METER for meter in meters])[None, :]
+    daylight = np.clip(np.sin(2 * np.pi * (hour_of_day - 6) / 24), 0, None)
+    load = np.where(solar, -meter_scale * 3 * daylight, load)
+
+    columns = {}
+    total_current = np.zeros((n_steps, n_meters))
+    total_power = np.zeros((n_steps, n_meters))
+    for i, phase in enumerate(PHASES):
+        voltage = 230 + rng.normal(0, 2, (n_steps, n_meters))
+        active_power = load / 3 * (1 + rng.normal(0, 0.1, (n_steps, n_meters)))
+        power_factor = np.clip(0.9 + rng.normal(0, 0.05, (n_steps, n_meters)), 0, 1)
+        apparent_power = np.abs(active_power) / power_factor.clip(0.1)
+        current = apparent_power / voltage
+
+        # Energy counters grow with the consumed and the returned energy
+        watt_hours = active_power * INTERVAL_SECONDS / 3600
+        active_energy = energy[2 * i] + np.cumsum(np.clip(watt_hours, 0, None), axis=0)
+        returned_energy = energy[2 * i + 1] + np.cumsum(np.clip(-watt_hours, 0, None), axis=0)
+        energy[2 * i], energy[2 * i + 1] = active_energy[-1], returned_energy[-1]
+
+        columns[f'{phase} Current'] = current
+        columns[f'{phase} Voltage'] = voltage
+        columns[f'{phase} Active Power'] = active_power
+        columns[f'{phase} Apparent Power'] = apparent_power
+        columns[f'{phase} Power Factor'] = power_factor
+        columns[f'{phase} Frequency'] = 50 + rng.normal(0, 0.02, (n_steps, n_meters))
+        columns[f'{phase} Total Active Energy'] = active_energy
+        columns[f'{phase} Total Active Returned Energy'] = returned_energy
+        total_current += current
+        total_power += active_power
+
+    columns['Total Current'] = total_current
+    columns['Total Active Power'] = total_power
+    columns['Total Apparent Power'] = sum(columns[f'{phase} Apparent Power'] for phase in PHASES)
+    columns['Total Active Energy'] = sum(columns[f'{phase} Total Active Energy'] for phase in PHASES)
+    columns['Total Active Returned Energy'] = sum(columns[f'{phase} Total Active Returned Energy'] for phase in PHASES)
+    columns['price'] = np.broadcast_to(hourly_price(hours)[:, None], (n_steps, n_meters))
+
+    df = pl.DataFrame({
+        'ts': np.repeat(START + steps * INTERVAL_SECONDS, n_meters).astype('datetime64[us]'),
+        'meter_id': np.tile(meters, n_steps),
+        **{name: values.ravel() for name, values in columns.items()},
+    })
+
+    # Every meter has an interruption of one hour now and then
+    meter_number = pl.Series(np.tile(np.arange(n_meters), n_steps))
+    hour_number = pl.Series(np.repeat(hours, n_meters))
+    return df.filter((hour_number + meter_number * 7) % 500 != 0)
+
+
+# Writes about rows rows of synthetic meter data for every meter in location_names to path
+def generate_meter_data(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    meters = list(location_names)
+    n_steps = rows // len(meters)
+    energy = np.zeros((2 * len(PHASES), len(meters)))
+
+    writer = None
+    try:
+        for first_step in range(0, n_steps, STEPS_PER_ROW_GROUP):
+            chunk = generate_chunk(rng, first_step, min(STEPS_PER_ROW_GROUP, n_steps - first_step), meters, energy)
+            table = chunk.to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic meter data in the schema of the uploaded files')
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_meter_data(args.path, args.rows, args.seed)
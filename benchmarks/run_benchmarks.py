@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import pathlib
+import platform
+import shutil
+import sys
+import threading
+import time
+from datetime import timedelta
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR.parent))
+
+import polars as pl
+import streamlit_stub
+from generate_data import generate_meter_data
+
+SQL_QUERY = 'SELECT meter_id, avg(total_active_power) AS power, max(price) AS price FROM self GROUP BY meter_id'
+streamlit_stub.install(SQL_QUERY)
+
+import data_analyzer
+from data_analyzer import DataAnalyzer, get_hourly_values
+from dataset_store import DatasetStore
+from ingestion import localize_timestamps
+from profiling import current_rss
+
+SCALES = {'1M': 1000000, '10M': 10000000, '100M': 100000000}
+BASELINE_PATH = BENCHMARK_DIR / 'baselines.json'
+DATA_DIR = BENCHMARK_DIR / 'data'
+LOCATION = 's-c8f09e82e7d0'  # Talonmiehen asunto
+NOISE_SECONDS = 0.05  # Differences in time below this are timer noise
+
+# SQL query results are exported next to the benchmark data instead of the app's query directory
+data_analyzer.QUERY_DIR = DATA_DIR / 'query_files'
+
+
+# Samples the resident set size in a background thread and keeps the highest value
+class PeakMemory:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+        return False
+
+
+# Runs function once and returns its result, the wall time in seconds and the peak RSS in MB.
+# The result caches and the exported query results are cleared first so every operation computes its results
+# from the data
+def measure(function):
+    data_analyzer.result_cache.clear()
+    data_analyzer.query_cache.clear()
+    data_analyzer.export_cache.clear()
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    return result, seconds, memory.peak / (1024 * 1024)
+
+
+# Returns the synthetic file of the scale, generating it on the first run
+def data_file(scale):
+    DATA_DIR.mkdir(exist_ok=True)
+    path = DATA_DIR / f'meter_data_{scale}.parquet'
+    if not path.exists():
+        print(f'Generating {SCALES[scale]} rows to {path}')
+        generate_meter_data(path, SCALES[scale])
+    return path
+
+
+# Runs the operations on one scale and returns their time and peak RSS by operation
+def run_scale(scale):
+    path = data_file(scale)
+    dataset_dir = DATA_DIR / f'dataset_{scale}'
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    results = {}
+
+    def run(name, function):
+        result, seconds, peak_rss_mb = measure(function)
+        results[name] = {'seconds': round(seconds, 4), 'peak_rss_mb': round(peak_rss_mb, 1)}
+        print(f'  {name:<24} {seconds:>10.3f} s {peak_rss_mb:>10.1f} MB')
+        return result
+
+    print(f'{scale} rows:')
+    store = DatasetStore(dataset_dir)
+    manifest = run('ingest_parquet', lambda: store.ingest(scale, path, scale, path.name))
+    analyzer_L = run('build_analyzer_L',
+                     lambda: DataAnalyzer(store.scan(manifest, 'L'), 'L', scale, store.hourly_rollup(manifest, 'L'),
+                                          store.gap_index(manifest, 'L')))
+    analyzer_total = run('build_analyzer_total',
+                         lambda: DataAnalyzer(store.scan(manifest, 'Total'), 'Total', scale,
+                                              store.hourly_rollup(manifest, 'Total'),
+                                              store.gap_index(manifest, 'Total')))
+    streamlit_stub.st.session_state.locations = analyzer_total.hourly_rollup['meter_id'].unique().to_list()
+
+    # The charts are drawn for the whole time range of the data
+    start = analyzer_total.hourly_rollup['ts'].min().date()
+    end = analyzer_total.hourly_rollup['ts'].max().date() + timedelta(days=1)
+    raw_df = analyzer_total.scan_range(LOCATION, start, end).select(['ts', 'meter_id', 'total_active_power',
+                                                                    'price']).collect()
+    naive_df = raw_df.with_columns(pl.col('ts').dt.replace_time_zone(None))
+
+    run('localize_timestamps', lambda: localize_timestamps(naive_df))
+    run('get_hourly_values', lambda: get_hourly_values(raw_df))
+    run('prepare_dataframe', lambda: analyzer_L.prepare_dataframe(LOCATION, start, end))
+    run('line_chart', lambda: analyzer_L.line_chart(LOCATION, start, end))
+    run('draw_heatmaps', lambda: analyzer_L.draw_heatmaps(LOCATION, start, end))
+    run('expenses_line_chart', lambda: analyzer_total.expenses_line_chart(start, end))
+    run('cost_effectiveness', lambda: analyzer_total.cost_effectiveness(start, end))
+    run('expense_report', analyzer_total.expense_report)
+    run('data_availability', analyzer_total.data_availability)
+    run('query_with_sql', analyzer_total.query_with_sql)
+    run('show_sample', analyzer_L.show_sample)
+    run('describe_dataframe', analyzer_L.describe_dataframe)
+
+    data_analyzer.export_cache.clear()
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    return results
+
+
+# Compares the results with the baselines and returns the operations that are slower or use more memory
+# than the baseline by more than tolerance. Operations that are within NOISE_SECONDS of the baseline are not slower
+def find_regressions(results, baselines, tolerance):
+    regressions = []
+    for scale, operations in results.items():
+        for name, result in operations.items():
+            baseline = baselines.get('results', {}).get(scale, {}).get(name)
+            if baseline is None:
+                continue
+            for metric in ('seconds', 'peak_rss_mb'):
+                ratio = result[metric] / baseline[metric] if baseline[metric] > 0 else 1.0
+                if metric == 'seconds' and result[metric] - baseline[metric] < NOISE_SECONDS:
+                    continue
+                if ratio > tolerance:
+                    regressions.append(f'{scale} {name} {metric}: {result[metric]} vs {baseline[metric]} '
+                                       f'({ratio:.2f}x)')
+    return regressions
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'polars': pl.__version__,
+            'cpu_count': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DataAnalyzer hot paths on synthetic meter data')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['1M'])
+    parser.add_argument('--baseline', default=str(BASELINE_PATH))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results of the run as the baseline of its scales')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='ratio to the baseline above which an operation is reported as a regression')
+    args = parser.parse_args()
+
+    results = {scale: run_scale(scale) for scale in args.scales}
+
+    baseline_path = pathlib.Path(args.baseline)
+    baselines = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    if args.save_baseline:
+        baselines['machine'] = machine()
+        baselines.setdefault('results', {}).update(results)
+        baseline_path.write_text(json.dumps(baselines, indent=2) + '\n')
+        print(f'Baselines saved to {baseline_path}')
+    else:
+        if baselines.get('machine') and baselines['machine'] != machine():
+            print(f'Baselines were measured on another machine: {baselines["machine"]}')
+        regressions = find_regressions(results, baselines, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
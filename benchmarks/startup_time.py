@@ -0,0 +1,51 @@
+import argparse
+import pathlib
+import statistics
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# The modules app.py imports when the server starts
+APP_MODULES = ['streamlit', 'polars', 'data_analyzer', 'dataset_registry', 'dataset_store', 'profiling']
+
+# Libraries that should only be imported by the code paths that use them
+HEAVY_MODULES = ['numpy', 'pandas', 'plotly', 'pyarrow', 'sklearn']
+
+
+# Imports the modules in a new interpreter and returns the -X importtime lines of the top-level imports
+# and the heavy modules that were imported
+def import_profile(modules):
+    code = (f'import sys; sys.path.insert(0, {str(ROOT)!r}); import {", ".join(modules)}; '
+            f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            check=True, cwd=ROOT)
+
+    # Each line is 'import time: <self us> | <cumulative us> | <indented module name>'
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((name[1:].rstrip(), int(cumulative)))
+    loaded = [name for name in result.stdout.strip().split(',') if name]
+    return imports, loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the cold import time of the modules app.py starts with')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(args.repeat):
+        imports, loaded = import_profile(APP_MODULES)
+        top_level = [(name, cumulative) for name, cumulative in imports if name in APP_MODULES]
+        totals.append(sum(cumulative for _, cumulative in top_level))
+
+    print(f'Cold import of {", ".join(APP_MODULES)}: {statistics.median(totals) / 1000:.0f} ms '
+          f'(median of {args.repeat})')
+    print('Import time of each module in the last run:')
+    for name, cumulative in sorted(top_level, key=lambda item: item[1], reverse=True):
+        print(f'  {name:<32} {cumulative / 1000:>8.1f} ms')
+    print(f'Heavy modules imported at startup: {", ".join(loaded) or "none"}')
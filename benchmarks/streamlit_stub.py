@@ -0,0 +1,46 @@
+import streamlit as st
+
+
+# Session state that works without a running Streamlit server
+class SessionState(dict):
+    def __getattr__(self, name):
+        return self.get(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class Element:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def progress(self, *args, **kwargs):
+        pass
+
+    def empty(self):
+        pass
+
+
+def do_nothing(*args, **kwargs):
+    return None
+
+
+# Replaces the Streamlit calls used by DataAnalyzer so the benchmarks run headless.
+# Every checkbox is checked except 'Hide interruptions', buttons count as clicked, radios return their first option
+# and text inputs return query
+def install(query=''):
+    st.session_state = SessionState(query_button_clicked=True, line_chart_button_clicked=True,
+                                    heatmap_button_clicked=True, expenses_button_clicked=True,
+                                    downsampling='minmax')
+    st.checkbox = lambda label, *args, **kwargs: label != 'Hide interruptions'
+    st.button = lambda *args, **kwargs: True
+    st.text_input = lambda *args, **kwargs: query
+    st.radio = lambda label, options, *args, **kwargs: list(options)[0]
+    st.columns = lambda spec, **kwargs: [Element() for _ in range(spec if isinstance(spec, int) else len(spec))]
+    st.spinner = lambda *args, **kwargs: Element()
+    st.progress = lambda *args, **kwargs: Element()
+    for name in ['write', 'line_chart', 'plotly_chart', 'download_button', 'dataframe', 'success', 'info']:
+        setattr(st, name, do_nothing)
@@ -0,0 +1,71 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Returns a content hash for the given parts, used as a cache key
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# Least recently used cache bounded by the number of entries and their total size in bytes.
+# It is shared by all sessions of the Streamlit server, so access is locked.
+# on_evict is called with each value that is evicted, cleared or too large to store,
+# for values that hold something outside the cache, like a file
+class LRUCache:
+    def __init__(self, max_entries, max_bytes, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def clear(self):
+        with self.lock:
+            if self.on_evict is not None:
+                for value, _ in self.entries.values():
+                    self.on_evict(value)
+            self.entries.clear()
+            self.total_bytes = 0
+
+    # Values larger than the whole cache are not stored
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                if self.on_evict is not None:
+                    self.on_evict(value)
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+
+            # Evict the least recently used entries until the cache fits its limits
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (evicted, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+
+
+# Approximate size in bytes of a cached value: DataFrames, NumPy arrays and tuples or lists of them
+def estimated_size(value):
+    if hasattr(value, 'estimated_size'):
+        return value.estimated_size()
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(estimated_size(item) for item in value)
+    return 64
@@ -1,13 +1,52 @@
+import functools
+import io
+import os
 import pathlib
+import random
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
 import polars as pl
-import pandas as pd
-import numpy as np
 import streamlit as st
-from sklearn.preprocessing import MinMaxScaler
-import plotly.express as px
+from caching import LRUCache, content_hash, estimated_size
 from dictionaries import location_names, units
-import time
-import os
+from profiling import profiled, stage
+
+# Timestamps are localized to this time zone once at ingestion. Polars stores them as UTC,
+# so sorting and ranges are in real time order and dates and hours are in local time
+TIMEZONE = 'Europe/Helsinki'
+
+# Row counts and pages of SQL query results, shared by all sessions
+query_cache = LRUCache(max_entries=256, max_bytes=256 * 1024 * 1024)
+
+# Rows of SQL query results shown on one page
+QUERY_PAGE_SIZE = 100
+
+# Computed chart data for each column, so a rerun only computes the columns that changed
+result_cache = LRUCache(max_entries=1024, max_bytes=512 * 1024 * 1024)
+
+# Worker pool for independent per-meter and per-sensor work, shared by all sessions.
+# Polars and NumPy release the GIL, so threads use all cores without copying the data to other processes
+WORKERS = os.cpu_count() or 1
+worker_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='data_analyzer')
+
+
+# Runs function for each item in the worker pool and returns the results in the order of the items.
+# Streamlit elements can only be written from the script thread, so function must not write any
+def parallel_map(function, items):
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    return list(worker_pool.map(function, items))
+
+
+# Splits columns into at most one chunk for each worker
+def split_columns(columns):
+    n_chunks = min(len(columns), WORKERS)
+    return [columns[i::n_chunks] for i in range(n_chunks)]
+
 
 def callback_query():
     st.session_state.query_button_clicked = True
@@ -25,87 +64,320 @@ def callback_expenses():
     st.session_state.expenses_button_clicked = True
 
 
-# Function to remove files older than a certain age
-def remove_old_files(directory, age_in_seconds):
-    now = time.time()
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        if os.path.isfile(file_path) and now - os.path.getmtime(file_path) > age_in_seconds:
-            os.remove(file_path)
-
-
-# Replace any characters that are not allowed in a filename
-def sanitize_filename(filename):
-    sanitized_filename = ''
-    for letter in filename:
-        sanitized_filename += switch(letter)
-    return sanitized_filename
-
-
-def switch(symbol):
-    if symbol == "<":
-        return "LESS_THAN"
-    if symbol == ">":
-        return "GREATER_THAN"
-    if symbol == ":":
-        return "COLON"
-    if symbol == ";":
-        return ""
-    if symbol == "\"":
-        return "D_QUOTE"
-    if symbol == "/":
-        return "F_SLASH"
-    if symbol == "\\":
-        return "B_SLASH"
-    if symbol == "|":
-        return "OR"
-    if symbol == "?":
-        return "CONDITION"
-    if symbol == "*":
-        return "ALL"
-    return symbol
-
-
-def to_helsinki_time(df):
-    if 'ts' in df.columns:
-        df['ts'] = pd.to_datetime(df['ts'])
-        if df['ts'].iloc[0].month < 6:
-            df['ts'] = df['ts'].dt.tz_localize('Europe/Helsinki', nonexistent='shift_forward')
-        else:
-            df['ts'] = df['ts'].dt.tz_localize('Europe/Helsinki', nonexistent='shift_backward')
-        df.set_index('ts', inplace=True)
-    return df
+# Directory of the SQL query results prepared for download
+QUERY_DIR = pathlib.Path('./query_files/')
+
+
+def remove_export(path):
+    path.unlink(missing_ok=True)
+
+
+# Paths of the query results in QUERY_DIR by query, shared by all sessions.
+# An evicted path's file is removed, so the directory stays within the limits of the cache
+export_cache = LRUCache(max_entries=64, max_bytes=2 * 1024 * 1024 * 1024, on_evict=remove_export)
+
+# Files left by an earlier server process are not in export_cache, so they are removed when the module is loaded
+if QUERY_DIR.is_dir():
+    for leftover in QUERY_DIR.iterdir():
+        if leftover.is_file():
+            remove_export(leftover)
+
+
+# Quoted string literals and identifiers of an SQL query, with '' or "" for a quote inside them
+QUOTED_SQL = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+# Same query with different whitespace or a trailing semicolon gives the same cache key.
+# Whitespace inside quotes is part of the query, so it is kept
+def normalize_query(query_string):
+    parts = QUOTED_SQL.split(query_string)
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part)
+                   for i, part in enumerate(parts)).strip().rstrip(';').strip()
 
 
 def get_hourly_values(df):
     # Select only numeric columns
-    numeric_cols = df.select_dtypes(include='number').columns
-    numeric_df = df[numeric_cols]
+    numeric_cols = [col for col, dtype in df.schema.items() if dtype.is_numeric()]
 
-    # Resample the data to hourly frequency and compute the mean
-    hourly_df = numeric_df.resample('h').mean()
+    # Resample the data to hourly frequency and compute the mean, hours without data are null
+    hourly_df = (df.sort('ts')
+                 .group_by_dynamic('ts', every='1h')
+                 .agg(pl.col(numeric_cols).mean())
+                 .upsample('ts', every='1h'))
     return hourly_df
 
 
 def get_hourly_values_fill_none(df):
     # Select only numeric columns
-    numeric_cols = df.select_dtypes(include='number').columns
-    numeric_df = df[numeric_cols]
+    numeric_cols = [col for col, dtype in df.schema.items() if dtype.is_numeric()]
 
     # Resample the data to hourly frequency and compute the mean
-    hourly_df = numeric_df.resample('h').mean()
+    hourly_df = get_hourly_values(df)
 
     # Fill null values with the mean
-    hourly_df[numeric_cols] = hourly_df[numeric_cols].fillna(hourly_df[numeric_cols].mean())
+    hourly_df = hourly_df.with_columns(pl.col(numeric_cols).fill_null(pl.col(numeric_cols).mean()))
     return hourly_df
 
 
-def draw_heatmap(data, sensor):
-    # Convert index to string for proper display in Plotly
-    data.index = data.index.astype(str)
+# Scales values to the range 0...1. Like MinMaxScaler, a constant column is scaled to 0
+def min_max_scale(values, minimum, maximum):
+    value_range = maximum - minimum
+    return (values - minimum) / pl.when(value_range != 0).then(value_range).otherwise(1)
+
+
+# Dates from the date inputs are turned into datetimes at local midnight, naive datetimes are taken as local time
+def to_datetime(value):
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime.combine(value, time(), tzinfo=ZoneInfo(TIMEZONE))
+    if value.tzinfo is None:
+        return value.replace(tzinfo=ZoneInfo(TIMEZONE))
+    return value
+
+
+# Mean of means weighted by the number of values behind each mean, null when there are no values
+def weighted_mean(name):
+    count = pl.col(f'{name}_count')
+    return pl.when(count.sum() > 0).then((pl.col(f'{name}_mean').fill_null(0) * count).sum() / count.sum())
+
+
+# Aggregates every numeric column per meter into time buckets of the given length, e.g. '1h'.
+# Expenses are also aggregated separately for positive and negative values for cost-effectiveness
+def build_rollup(dataframe, every):
+    schema = dataframe.collect_schema()
+    numeric_cols = [col for col, dtype in schema.items() if dtype.is_numeric()]
+
+    aggregations = [pl.len().alias('rows')]
+    for col in numeric_cols:
+        aggregations += [
+            pl.col(col).mean().alias(f'{col}_mean'),
+            pl.col(col).min().alias(f'{col}_min'),
+            pl.col(col).max().alias(f'{col}_max'),
+            pl.col(col).count().alias(f'{col}_count'),
+        ]
+    if 'expenses' in numeric_cols:
+        positive = pl.col('expenses').filter(pl.col('expenses') >= 0)
+        negative = pl.col('expenses').filter(pl.col('expenses') < 0)
+        aggregations += [
+            positive.mean().alias('expenses_positive_mean'),
+            positive.count().alias('expenses_positive_count'),
+            negative.mean().alias('expenses_negative_mean'),
+            negative.count().alias('expenses_negative_count'),
+        ]
+
+    return (dataframe.sort(['meter_id', 'ts'])
+            .group_by_dynamic('ts', every=every, group_by='meter_id')
+            .agg(aggregations)
+            .collect())
+
+
+# Aggregates an hourly rollup into longer time buckets, e.g. '1d', without reading the raw rows again.
+# With every='1h' it merges partial hourly rollups of the same hours into one row
+def rollup_from_hourly(hourly, every):
+    aggregations = [pl.col('rows').sum()]
+    for col in hourly.columns:
+        if col.endswith('_count'):
+            name = col[:-len('_count')]
+            aggregations += [weighted_mean(name).alias(f'{name}_mean'), pl.col(col).sum()]
+        elif col.endswith('_min'):
+            aggregations.append(pl.col(col).min())
+        elif col.endswith('_max'):
+            aggregations.append(pl.col(col).max())
+
+    return hourly.group_by_dynamic('ts', every=every, group_by='meter_id').agg(aggregations)
+
+
+# A gap is a pause between two readings of a meter longer than GAP_FACTOR times its sampling interval,
+# which is the median of the meter's ts differences
+GAP_FACTOR = 2
+
+
+# Finds the sampling interval and the gaps of each meter of dataframe, a LazyFrame sorted by meter_id and ts.
+# The rows of each meter are found from the row counts of the hourly rollup, so only the ts of one meter is read
+# at a time. meters limits the search to some of the meters.
+# Returns the sampling table with the interval, first and last reading and number of readings of each meter,
+# and the gap index with the last reading before (start) and the first reading after (end) each gap
+def build_gap_index(dataframe, hourly_rollup, meters=None):
+    meter_type = hourly_rollup.schema['meter_id']
+    ts_type = dataframe.collect_schema()['ts']
+    meter_rows = (hourly_rollup.filter(pl.col('meter_id').is_not_null()).sort(['meter_id', 'ts'])
+                  .group_by('meter_id', maintain_order=True).agg(pl.col('rows').sum()))
+
+    samplings = []
+    gaps = []
+    offset = 0
+    for meter, rows in meter_rows.iter_rows():
+        if meters is None or meter in meters:
+            ts = dataframe.slice(offset, rows).select('ts').collect()['ts']
+            diffs = ts.diff()
+            # Repeated timestamps are left out of the interval
+            interval = diffs.filter(diffs > timedelta(0)).median()
+            samplings.append((meter, interval, ts[0], ts[-1], rows))
+            if interval is not None:
+                gaps.append(pl.DataFrame({'start': ts.shift(1), 'end': ts, 'duration': diffs})
+                            .filter(pl.col('duration') > interval * GAP_FACTOR)
+                            .select(pl.lit(meter, dtype=meter_type).alias('meter_id'), pl.all()))
+        offset += rows
+
+    sampling = pl.DataFrame(samplings, orient='row', schema={
+        'meter_id': meter_type, 'interval': pl.Duration('us'), 'first_ts': ts_type, 'last_ts': ts_type,
+        'readings': pl.Int64})
+    gap_schema = {'meter_id': meter_type, 'start': ts_type, 'end': ts_type, 'duration': pl.Duration('us')}
+    gap_index = pl.concat(gaps).cast(gap_schema) if gaps else pl.DataFrame(schema=gap_schema)
+    return sampling, gap_index
+
+
+# Updates the sampling table and the gap index with added_rows, the rows added to a dataset, from their ts and the
+# stored last reading of each meter, without reading the stored rows. Meters keep their stored interval.
+# Meters whose added rows are not all after their stored last reading can have a gap split by them,
+# so they are returned to be searched again with build_gap_index
+def extend_gap_index(sampling, gap_index, added_rows):
+    stored = {row['meter_id']: row for row in sampling.iter_rows(named=True)}
+    samplings = []
+    gaps = []
+    rescan = set()
+    for (meter,), rows in added_rows.partition_by('meter_id', as_dict=True).items():
+        ts = rows['ts'].sort()
+        previous = stored.get(meter)
+        if previous is not None and ts[0] <= previous['last_ts']:
+            rescan.add(meter)
+            continue
+
+        if previous is not None:
+            ts = pl.concat([pl.Series('ts', [previous['last_ts']], dtype=ts.dtype), ts])
+        diffs = ts.diff()
+        interval = previous['interval'] if previous is not None else None
+        if interval is None:
+            interval = diffs.filter(diffs > timedelta(0)).median()
+        first_ts = previous['first_ts'] if previous is not None else ts[0]
+        readings = previous['readings'] + rows.height if previous is not None else rows.height
+        samplings.append(pl.DataFrame([(meter, interval, first_ts, ts[-1], readings)], orient='row',
+                                      schema=sampling.schema))
+        if interval is not None:
+            gaps.append(pl.DataFrame({'start': ts.shift(1), 'end': ts, 'duration': diffs})
+                        .filter(pl.col('duration') > interval * GAP_FACTOR)
+                        .select(pl.lit(meter, dtype=gap_index.schema['meter_id']).alias('meter_id'), pl.all())
+                        .cast(dict(gap_index.schema)))
+
+    extended = [meter_sampling['meter_id'][0] for meter_sampling in samplings]
+    sampling = pl.concat([sampling.filter(~pl.col('meter_id').is_in(extended)), *samplings]).sort('meter_id')
+    gap_index = pl.concat([gap_index, *gaps]).sort(['meter_id', 'start'])
+    return sampling, gap_index, rescan
+
+
+# Periods of the expense report: the group_by_dynamic interval and the label format of each period.
+# Weekly windows start on Monday, so they are ISO weeks
+REPORT_PERIODS = {'Day': ('1d', '%Y-%m-%d'), 'ISO week': ('1w', '%G-W%V'), 'Month': ('1mo', '%Y-%m')}
+REPORT_VALUES = ['cost', 'profit', 'net_cost', 'consumption_kwh']
+
+
+# Cost, profit, net cost and consumption of every meter in every period, aggregated from the hourly rollup
+# in one grouped pass, with the change of each value from the meter's previous period.
+# The hourly values are summed the same way as in cost-effectiveness, so the totals of a period match it
+def build_period_report(hourly_rollup, period):
+    every, label = REPORT_PERIODS[period]
+    report = (hourly_rollup.filter(pl.col('meter_id').is_not_null())
+              .group_by_dynamic('ts', every=every, group_by='meter_id')
+              .agg(pl.col('expenses_positive_mean').sum().alias('cost'),
+                   (pl.col('expenses_negative_mean').sum() * (-1)).alias('profit'),
+                   pl.col('expenses_mean').sum().alias('net_cost'),
+                   (pl.col('total_active_power_mean').sum() / 1000).alias('consumption_kwh'),
+                   pl.col('rows').sum().alias('rows'))
+              .sort(['meter_id', 'ts']))
+    return report.select(
+        pl.col('ts').dt.strftime(label).alias('period'),
+        'meter_id',
+        pl.col('meter_id').cast(pl.String).replace(location_names).alias('location'),
+        *REPORT_VALUES,
+        *[pl.col(value).diff().over('meter_id').alias(f'{value}_change') for value in REPORT_VALUES],
+        'rows')
+
+
+# Milliseconds of ts in the fixed UTC offset, which a date axis shows as it is. Unlike the local wall time, the times
+# stay evenly spaced across the daylight saving changes and the two passes of the repeated autumn hour don't overlap
+def axis_time_ms(ts, offset):
+    return (ts.dt.epoch('ms') + offset // timedelta(milliseconds=1)).cast(pl.Float64).to_numpy()
+
+
+# Plotly figure of the lines of df with a WebGL trace for each line. Plotly sends NumPy arrays to the browser as
+# binary typed arrays, so the values are float32. Times are in the UTC offset of the first time, which the axis title
+# shows. Evenly spaced times, like hourly values that weren't downsampled, are sent once as the first time and
+# the step. Plotly has no x shared by traces, so otherwise every trace carries its own float64 array of the times.
+# The gaps, a DataFrame with start and end columns, are shaded over the whole height of the chart
+def line_figure(df, lines, gaps=None):
+    import numpy as np
+    import plotly.graph_objects as go
+
+    ts = df['ts']
+    offset = ts[0].utcoffset() if ts.dtype.time_zone is not None and len(ts) else timedelta(0)
+    x = axis_time_ms(ts, offset)
+
+    steps = np.diff(x)
+    axis = dict(x0=x[0], dx=steps[0]) if len(steps) and np.all(steps == steps[0]) else dict(x=x)
+    fig = go.Figure([go.Scattergl(**axis, y=df[line].cast(pl.Float32).to_numpy(), mode='lines', name=line)
+                     for line in lines])
+    shapes = []
+    if gaps is not None and not gaps.is_empty():
+        gap_starts = axis_time_ms(gaps['start'], offset).tolist()
+        gap_ends = axis_time_ms(gaps['end'], offset).tolist()
+        shapes = [dict(type='rect', xref='x', yref='paper', x0=gap_start, x1=gap_end, y0=0, y1=1,
+                       fillcolor='gray', opacity=0.25, line_width=0, layer='below')
+                  for gap_start, gap_end in zip(gap_starts, gap_ends)]
+    minutes = abs(offset) // timedelta(minutes=1)
+    fig.update_layout(
+        xaxis_type='date',
+        xaxis_title=f"Time (UTC{'-' if offset < timedelta(0) else '+'}{minutes // 60:02d}:{minutes % 60:02d})",
+        hovermode='x unified',
+        showlegend=len(lines) > 1,
+        shapes=shapes,
+        margin=dict(t=20)
+    )
+    return fig
+
+
+# Draws the lines of df against ts, downsampled to the number of points the chart can show.
+# The renderer is 'webgl' for a Plotly WebGL chart or 'legacy' for st.line_chart.
+# The gaps are shaded on the WebGL chart, st.line_chart can't shade them
+def draw_line_chart(df, lines, gaps=None):
+    # NumPy is only imported when the first chart is drawn, not when the app starts
+    from downsampling import downsample, point_budget
+
+    lines = [lines] if isinstance(lines, str) else lines
+    method = st.session_state.get('downsampling', 'minmax')
+    with stage('downsample', rows_in=df.height) as record:
+        chart_df = record.output(downsample(df, lines, point_budget(), method))
+    with stage('render', rows_in=chart_df.height):
+        if st.session_state.get('renderer', 'webgl') == 'webgl':
+            st.plotly_chart(line_figure(chart_df, lines, gaps), theme="streamlit")
+        else:
+            st.line_chart(chart_df, x='ts', y=lines)
+
+
+# Averages the sensors of location_df by day and hour in one aggregation.
+# Returns the days, the hours and a (sensor, day, hour) array, hours without data are NaN
+def build_heatmap_cube(location_df, sensors):
+    import numpy as np
+
+    grouped = location_df.group_by(
+        pl.col('ts').dt.date().alias('day'),
+        pl.col('ts').dt.hour().alias('hour')).agg(pl.col(sensors).mean())
 
-    # Create Plotly heatmap
-    fig = px.imshow(data.T, labels=dict(x="Date", y="Hour of Day", color=f"{units[sensor]}"))
+    days = grouped['day'].unique().sort()
+    hours = grouped['hour'].unique().sort()
+    cube = np.full((len(sensors), len(days), len(hours)), np.nan)
+    cube[:, days.search_sorted(grouped['day']).to_numpy(), hours.search_sorted(grouped['hour']).to_numpy()] = (
+        grouped.select(sensors).to_numpy(allow_copy=True).T)
+    return days, hours, cube
+
+
+# values is a (day, hour) array
+def heatmap_figure(values, days, hours, sensor):
+    import plotly.express as px
+
+    # Create Plotly heatmap with days on the x-axis and hours on the y-axis
+    fig = px.imshow(values.T,
+                    x=days.cast(pl.String).to_list(),
+                    y=hours.to_list(),
+                    labels=dict(x="Date", y="Hour of Day", color=f"{units[sensor]}"))
     fig.update_layout(
         title=f'{sensor}',
         xaxis_title='Date',
@@ -113,187 +385,388 @@ def draw_heatmap(data, sensor):
         width=400,
         height=500
     )
+    return fig
+
 
-    # Display the Plotly heatmap in Streamlit
-    st.plotly_chart(fig, theme="streamlit")
+# Daily coverage in percent of every meter, with a row for each location and a column for each day
+def availability_figure(daily_coverage):
+    import plotly.express as px
+
+    days = daily_coverage['day'].unique().sort()
+    locations = daily_coverage['location'].unique(maintain_order=True)
+    values = daily_coverage['coverage'].to_numpy().reshape(len(locations), len(days))
+    fig = px.imshow(values,
+                    x=days.cast(pl.String).to_list(),
+                    y=locations.to_list(),
+                    zmin=0, zmax=100, color_continuous_scale='RdYlGn', aspect='auto',
+                    labels=dict(x="Date", y="Location", color="Coverage %"))
+    fig.update_layout(
+        xaxis_title='Date',
+        yaxis_title='Location',
+        height=max(400, 25 * len(locations))
+    )
+    return fig
 
 
 class DataAnalyzer:
-    def __init__(self, dataframe, dataframe_type):
+    # dataframe is a pl.LazyFrame sorted by meter_id and ts, every method collects only the rows and columns it needs
+    # The hourly and daily rollups are built once here and the charts read from them.
+    # The hourly rollup has the row offset of each hour in the dataframe, so a meter's rows in a time range
+    # are found with a binary search instead of a scan
+    # fingerprint is the content hash of the uploaded file
+    # hourly_rollup and gap_index, the sampling table and gap index of build_gap_index, can be given
+    # when they were already built during ingestion
+    def __init__(self, dataframe, dataframe_type, fingerprint, hourly_rollup=None, gap_index=None):
         self.dataframe = dataframe
         self.dataframe_type = dataframe_type
-        self.query_dir = pathlib.Path('./query_files/')
-        self.cleanup_interval = 3600  # 1 hour
+        self.fingerprint = fingerprint
+        hourly_rollup = hourly_rollup if hourly_rollup is not None else build_rollup(dataframe, '1h')
+        self.hourly_rollup = hourly_rollup.sort(['meter_id', 'ts'], nulls_last=True).with_columns(
+            (pl.col('rows').cast(pl.Int64).cum_sum() - pl.col('rows')).alias('row_offset'))
+        self.daily_rollup = rollup_from_hourly(self.hourly_rollup, '1d')
+        self.meter_index = self.build_meter_index()
+        self.sampling, self.gap_index = (gap_index if gap_index is not None
+                                         else build_gap_index(dataframe, self.hourly_rollup))
+        self.build_query_plan = functools.lru_cache(maxsize=128)(self.compile_query)
+        self.query_dir = QUERY_DIR
+
+    # Maps each meter_id to its (first hour, end hour) in the hourly rollup and (first row, end row) in the dataframe
+    def build_meter_index(self):
+        meter_bounds = self.hourly_rollup.with_row_index('hour_index').group_by('meter_id').agg(
+            pl.col('hour_index').min().alias('hour_start'),
+            (pl.col('hour_index').max() + 1).alias('hour_end'),
+            pl.col('row_offset').min().alias('row_start'),
+            (pl.col('row_offset') + pl.col('rows')).max().alias('row_end'))
+        return {row[0]: row[1:] for row in meter_bounds.iter_rows()}
+
+    # Returns the hourly rollup rows of a meter from start to end as a zero-copy slice
+    def hourly_range(self, location, start, end):
+        if location not in self.meter_index:
+            return self.hourly_rollup.clear()
+
+        hour_start, hour_end, _, _ = self.meter_index[location]
+        meter_hours = self.hourly_rollup.slice(hour_start, hour_end - hour_start)
+        first = meter_hours['ts'].search_sorted(to_datetime(start), side='left')
+        last = meter_hours['ts'].search_sorted(to_datetime(end), side='left')
+        return meter_hours.slice(first, last - first)
+
+    # Returns the rows of a meter from start to end. Only the row groups of that slice are read
+    def scan_range(self, location, start, end):
+        start = to_datetime(start)
+        hours = self.hourly_range(location, start.replace(minute=0, second=0, microsecond=0), end)
+        if hours.is_empty():
+            return self.dataframe.clear()
+
+        row_start = hours['row_offset'][0]
+        row_end = hours['row_offset'][-1] + hours['rows'][-1]
+        return self.dataframe.slice(row_start, row_end - row_start).filter(
+            (pl.col('ts') >= start) & (pl.col('ts') < to_datetime(end)))
+
+    # Returns the columns of the chosen meters from start to end, all meters when meters is None.
+    # aggregation is None for raw rows, 'hourly' or 'daily' for the rollups, where each column comes as
+    # <column>_<stat> for every stat in stats ('mean', 'min', 'max' or 'count')
+    def query(self, meters, start, end, columns, aggregation=None, stats=('mean',)):
+        meters = tuple(self.meter_index) if meters is None else tuple(meters)
+        plan = self.build_query_plan(meters, to_datetime(start), to_datetime(end), tuple(columns), aggregation,
+                                     tuple(stats))
+        return plan.collect()
+
+    # Compiles a query into a LazyFrame. The plans are memoized by build_query_plan,
+    # so reruns with the same parameters reuse them
+    def compile_query(self, meters, start, end, columns, aggregation, stats):
+        if aggregation is None:
+            if not meters:
+                return self.dataframe.clear().select(['ts', 'meter_id', *columns])
+            return pl.concat([self.scan_range(meter, start, end) for meter in meters]).select(
+                ['ts', 'meter_id', *columns])
+
+        selected = ['ts', 'meter_id'] + [f'{col}_{stat}' for col in columns for stat in stats]
+        if aggregation == 'hourly':
+            if not meters:
+                return self.hourly_rollup.clear().lazy().select(selected)
+            return pl.concat([self.hourly_range(meter, start, end) for meter in meters]).lazy().select(selected)
+        if aggregation == 'daily':
+            ts_type = self.daily_rollup.schema['ts']
+            return self.daily_rollup.lazy().filter(
+                pl.col('meter_id').is_in(meters)
+                & (pl.col('ts') >= pl.lit(start, dtype=ts_type))
+                & (pl.col('ts') < pl.lit(end, dtype=ts_type))).select(selected)
+        raise ValueError(f'Unknown aggregation: {aggregation}')
+
+    # Returns the gaps of a meter that overlap the time range from start to end
+    def gaps_in_range(self, location, start, end):
+        ts_type = self.gap_index.schema['start']
+        return self.gap_index.filter(
+            (pl.col('meter_id') == location)
+            & (pl.col('end') > pl.lit(to_datetime(start), dtype=ts_type))
+            & (pl.col('start') < pl.lit(to_datetime(end), dtype=ts_type)))
 
     def list_columns(self):
-        for column in self.dataframe.columns:
+        for column in self.dataframe.collect_schema().names():
             st.write(column)
 
+    # Picks random row numbers from the row count of the hourly rollup and collects each row with a slice,
+    # so only the row groups that hold the sampled rows are read
+    @profiled('show_sample')
     def show_sample(self):
-        return self.dataframe.sample(5)
-
-    def describe_dataframe(self):
-        return self.dataframe.describe()
-
-    # Makes a query to the dataframe and saves the result in a parquet file
-    # The filename is the query string
+        height = self.hourly_rollup['rows'].sum()
+        rows = sorted(random.sample(range(height), min(5, height)))
+        if not rows:
+            return self.dataframe.clear().collect()
+        return pl.concat([self.dataframe.slice(row, 1) for row in rows]).collect()
+
+    # Summary statistics of the numeric columns, for all meters or for each meter when by_meter is True.
+    # They are computed in one streaming pass over the dataset with approximate quantiles and cached by column,
+    # so the dataset is read once and switching between the views doesn't read it again
+    @profiled('describe_dataframe')
+    def describe_dataframe(self, by_meter=False):
+        # NumPy is only imported when the statistics are first computed
+        from dataset_statistics import STATISTICS, describe_columns
+
+        columns = [col for col, dtype in self.dataframe.collect_schema().items() if dtype.is_numeric()]
+        # The statistics of all missing columns are computed in one streaming pass over the dataset
+        with stage('compute'):
+            summaries = self.cached_columns(columns, lambda missing: describe_columns(self.dataframe, missing),
+                                            'describe', split=False)
+        if by_meter:
+            return pl.concat([summary.filter(pl.col('meter_id').is_not_null())
+                              .select('meter_id', pl.lit(col).alias('column'), *STATISTICS)
+                              for col, summary in zip(columns, summaries)])
+        return pl.DataFrame({'statistic': STATISTICS,
+                             **{col: [float(value) if value is not None else None
+                                      for value in summary.row(-1)[1:]]
+                                for col, summary in zip(columns, summaries)}})
+
+    # Returns a result of an SQL query from the query cache, computing it with compute() when it isn't there.
+    # part tells apart the results of one query, like its row count and its pages
+    def cached_query_result(self, key, part, compute):
+        part_key = content_hash(key, part)
+        result = query_cache.get(part_key)
+        if result is None:
+            result = compute()
+            query_cache.put(part_key, result, estimated_size(result))
+        return result
+
+    # Runs an SQL query lazily. The result is never collected as a whole: the row count is a streaming count,
+    # pages are collected one at a time with the slice pushed into the query plan,
+    # and the download is written to disk with a streaming sink.
+    # Counts and pages are cached by the query and the dataset they were made from
+    @profiled('query_with_sql')
     def query_with_sql(self):
-        # Cleanup old files every time the query is run
-        remove_old_files(self.query_dir, self.cleanup_interval)
-
         query_string = st.text_input('Enter the SQL query:')
 
         if not st.session_state.query_button_clicked:
             st.button('Click here to see the results', on_click=callback_query)
         if st.session_state.query_button_clicked:
+            key = content_hash(self.fingerprint, self.dataframe_type, normalize_query(query_string))
             result = self.dataframe.sql(query_string)
 
-            dirpath = pathlib.Path('./query_files/')
-            file_name = sanitize_filename(query_string.replace(' ', '_'))
-            path = dirpath / f'{self.dataframe_type}_{file_name}.parquet'
-
-            # Create the directory if it doesn't exist
-            dirpath.mkdir(exist_ok=True)
-            if not pathlib.Path(path).exists():
-                result.write_parquet(path)
+            with stage('count'):
+                height = self.cached_query_result(
+                    key, 'count', lambda: result.select(pl.len()).collect(engine='streaming').item())
+            pages = max(1, -(-height // QUERY_PAGE_SIZE))
 
             st.write('<h3>Result of SQL query:</h3>', unsafe_allow_html=True)
-            st.write(result.head())
-            st.write(f"Number of rows: {result.height}")
-
-            # Load the data from the parquet file for downloading
-            with open(path, "rb") as f:
-                data = f.read()
-
-            # Create a download button
-            st.download_button(
-                label="Download result as Parquet file",
-                data=data,
-                file_name=path.name,
-                mime="application/octet-stream"
-            )
-
-    # Returns the dataframe for a chosen meter_id and its chosen sensors
+            page = st.number_input('Page', value=1, min_value=1, max_value=pages) if pages > 1 else 1
+            with stage('page') as record:
+                page_df = record.output(self.cached_query_result(
+                    key, f'page {page}',
+                    lambda: result.slice((page - 1) * QUERY_PAGE_SIZE, QUERY_PAGE_SIZE).collect()))
+            st.write(page_df)
+            st.write(f"Number of rows: {height}")
+            if pages > 1:
+                st.write(f'Page {page} / {pages}')
+
+            # The whole result is written to disk only when it is downloaded
+            path = export_cache.get(key)
+            if path is None and st.button('Prepare the result for download'):
+                with stage('export'):
+                    self.query_dir.mkdir(exist_ok=True)
+                    path = self.query_dir / f'{self.dataframe_type}_query_{key[:12]}.parquet'
+                    # Each export has its own temporary file, so sessions exporting the same query don't collide
+                    temp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+                    result.sink_parquet(temp_path)
+                    temp_path.replace(path)
+                    export_cache.put(key, path, path.stat().st_size)
+                path = export_cache.get(key)
+                if path is None:
+                    st.write('The result is too large to download')
+            if path is not None:
+                # Another session can evict the file before it is opened
+                try:
+                    with open(path, "rb") as f:
+                        # Create a download button
+                        st.download_button(
+                            label="Download result as Parquet file",
+                            data=f,
+                            file_name=path.name,
+                            mime="application/octet-stream"
+                        )
+                except FileNotFoundError:
+                    st.write('The prepared result was removed, prepare it again')
+
+    # Looks up per-column results in the result cache by the dataset, key_parts and the column.
+    # Only the missing columns are computed, with compute(missing_columns) returning the results by column.
+    # The missing columns are split into chunks that are computed in parallel in the worker pool.
+    # With split=False they are computed in one call, for computations that make one pass for all columns
+    def cached_columns(self, columns, compute, *key_parts, split=True):
+        keys = {col: content_hash(self.fingerprint, self.dataframe_type, *key_parts, col) for col in columns}
+        results = {col: result_cache.get(key) for col, key in keys.items()}
+        missing = [col for col, result in results.items() if result is None]
+        if missing:
+            for chunk_results in parallel_map(compute, split_columns(missing) if split else [missing]):
+                for col, result in chunk_results.items():
+                    result_cache.put(keys[col], result, estimated_size(result))
+                    results[col] = result
+        return [results[col] for col in columns]
+
+    # Returns the chosen sensors and the hourly rollup rows of the chosen meter_id
     def prepare_dataframe(self, location, start, end):
-        query_string = f"SELECT * FROM self WHERE meter_id = '{location}'"
-        location_df = self.dataframe.sql(query_string)
-        location_df = location_df.filter((pl.col('ts') >= start) & (pl.col('ts') < end))
+        columns = self.dataframe.collect_schema().names()
 
-        number_of_columns = 2 if len(location_df.columns) < 15 else 6
+        number_of_columns = 2 if len(columns) < 15 else 6
         cols = st.columns(number_of_columns)
         sensors = []
-        for i, sensor in enumerate(location_df.columns, start=-2):
+        for i, sensor in enumerate(columns, start=-2):
             with cols[i % number_of_columns]:
                 if sensor != 'ts' and sensor != 'meter_id' and sensor != 'expenses' and sensor != 'power_to_price_ratio':
                     if st.checkbox(sensor):
                         sensors.append(sensor)
 
-        # Convert to pandas before drawing line chart or heatmap
-        location_df = location_df.to_pandas()
-        location_df['ts'] = pd.to_datetime(location_df['ts'])
-        location_df.set_index('ts', inplace=True, drop=False)
-        return sensors, location_df
+        return sensors, self.hourly_range(location, start, end)
+
+    # Returns the normalized hourly values of each sensor as a (ts, sensor) dataframe
+    def compute_line_values(self, location, start, end, sensors, fill_none):
+        location_df = self.query([location], start, end, sensors, 'hourly', ('mean', 'min', 'max'))
+
+        # Normalize selected columns with the minimum and maximum of the raw values
+        location_df = location_df.select(['ts'] + [
+            min_max_scale(pl.col(f'{sensor}_mean'), pl.col(f'{sensor}_min').min(), pl.col(f'{sensor}_max').max())
+            .alias(sensor)
+            for sensor in sensors])
+
+        # When fill_none is set, None values are set to the mean
+        if fill_none:
+            hourly_df = get_hourly_values_fill_none(location_df)
+        else:
+            hourly_df = get_hourly_values(location_df)
+        return {sensor: hourly_df.select(['ts', sensor]) for sensor in sensors}
 
     # Draws line charts for chosen sensors
+    @profiled('line_chart')
     def line_chart(self, location, start, end):
         lines, location_df = self.prepare_dataframe(location, start, end)
 
         if not st.session_state.line_chart_button_clicked:
             st.button('Click here to draw line charts', on_click=callback_lines)
         if st.session_state.line_chart_button_clicked:
-            if len(location_df) > 0:
-                # Normalize selected columns
-                scaler = MinMaxScaler()
+            if location_df.height > 0:
                 if len(lines) > 0:
-                    location_df[lines] = scaler.fit_transform(location_df[lines])
-                    location_df = to_helsinki_time(location_df)
-
-                    st.write(f'<h2>{location_names[location]}</h2>', unsafe_allow_html=True)
+                    st.write(f'<h2>{location_names.get(location, location)}</h2>', unsafe_allow_html=True)
                     st.write(f'<h4>meter_id: {location}</h4>', unsafe_allow_html=True)
                     st.write(f'<h4>Time range: {start} - {end}</h4>', unsafe_allow_html=True)
 
-                    # When checked, None values are set to 0
-                    if st.checkbox("Hide interruptions"):
-                        hourly_df = get_hourly_values_fill_none(location_df)
-                    else:
-                        hourly_df = get_hourly_values(location_df)
-
-                    st.line_chart(hourly_df[lines])
+                    # When checked, None values are set to the mean and the gaps are not shaded
+                    fill_none = st.checkbox("Hide interruptions")
+                    with stage('compute', rows_in=location_df.height) as record:
+                        line_values = self.cached_columns(
+                            lines,
+                            lambda missing: self.compute_line_values(location, start, end, missing, fill_none),
+                            location, start, end, 'hourly', fill_none)
+                        hourly_df = record.output(functools.reduce(
+                            lambda left, right: left.join(right, on='ts', how='left'), line_values))
+
+                    # The gaps of the time range come from the gap index built at ingestion
+                    gaps = self.gaps_in_range(location, start, end)
+                    draw_line_chart(hourly_df, lines, None if fill_none else gaps)
+
+                    if not gaps.is_empty():
+                        st.write(f'<h4>Interruptions in the time range: {gaps.height}</h4>', unsafe_allow_html=True)
+                        st.dataframe(gaps.select(['start', 'end', 'duration']), hide_index=True)
                 else:
                     st.write('Choose columns to draw line chart')
             else:
                 st.write('Choose another time range')
 
+    # Returns the days, the hours and a (day, hour) array of each sensor
+    def compute_heatmaps(self, location, start, end, sensors):
+        location_df = self.query([location], start, end, sensors, 'hourly').select(
+            ['ts'] + [pl.col(f'{sensor}_mean').alias(sensor) for sensor in sensors])
+        days, hours, cube = build_heatmap_cube(location_df, sensors)
+        return {sensor: (days, hours, cube[i]) for i, sensor in enumerate(sensors)}
+
     # Draws heatmaps for chosen sensors
+    @profiled('draw_heatmaps')
     def draw_heatmaps(self, location, start, end):
         sensors, location_df = self.prepare_dataframe(location, start, end)
 
         if not st.session_state.heatmap_button_clicked:
             st.button('Click here to draw heatmap', on_click=callback_heatmap)
         if st.session_state.heatmap_button_clicked:
-            if len(location_df) > 0:
+            if location_df.height > 0:
                 if len(sensors) > 0:
-                    #location_df[sensors] = location_df[sensors].fillna(0)
-
-                    # Prepare data for heatmap
-                    location_df['hour'] = location_df.index.hour
-                    location_df['day'] = location_df.index.date
-                    location_df = to_helsinki_time(location_df)
-
-                    st.write(f'<h2>{location_names[location]}</h2>', unsafe_allow_html=True)
+                    # Prepare data for all heatmaps, sensors that were drawn before come from the result cache
+                    with stage('compute', rows_in=location_df.height) as record:
+                        heatmaps = record.output(self.cached_columns(
+                            sensors,
+                            lambda missing: self.compute_heatmaps(location, start, end, missing),
+                            location, start, end, 'heatmap'))
+
+                    st.write(f'<h2>{location_names.get(location, location)}</h2>', unsafe_allow_html=True)
                     st.write(f'<h4>meter_id: {location}</h4>', unsafe_allow_html=True)
                     st.write(f'<h4>Time range: {start} - {end}</h4>', unsafe_allow_html=True)
 
-                    # Draw heatmaps in columns
-                    columns = st.columns(4)
-                    for i, sensor in enumerate(sensors, start=0):
-                        heatmap_data = location_df.pivot_table(index='day', columns='hour', values=sensor,
-                                                               aggfunc='mean')
-                        with columns[i % 4]:
-                            draw_heatmap(heatmap_data, sensor)
+                    # Build the figures in the worker pool and draw them in columns in the order of the sensors
+                    with stage('figures'):
+                        figures = parallel_map(lambda args: heatmap_figure(*args),
+                                               [(values, days, hours, sensor)
+                                                for sensor, (days, hours, values) in zip(sensors, heatmaps)])
+                    with stage('render'):
+                        columns = st.columns(4)
+                        for i, figure in enumerate(figures, start=0):
+                            with columns[i % 4]:
+                                st.plotly_chart(figure, theme="streamlit")
                 else:
                     st.write('Choose columns to draw heatmap')
             else:
                 st.write('Choose another time range')
 
-    # Creates a pivot table with the chosen meter_id's as columns and expenses as their values.
-    def prepare_expenses_df(self, start, end):
-        query_string = f"""
-            SELECT ts, meter_id, expenses
-            FROM self
-            WHERE ts >= '{start}' AND ts < '{end}'
-        """
-        expenses_df = self.dataframe.sql(query_string)
+    # Returns the hourly expenses of each location as a (ts, location name) dataframe
+    def compute_expenses(self, start, end, locations):
+        expenses_df = self.query(locations, start, end, ['expenses'], 'hourly')
+        return {location: expenses_df.filter(pl.col('meter_id') == location).select(
+            ['ts', pl.col('expenses_mean').alias(location_names.get(location, location))])
+            for location in locations}
 
+    # Creates a table with the chosen meter_id's as columns and hourly expenses as their values.
+    def prepare_expenses_df(self, start, end):
         cols = st.columns(5)
         locations = []
         for i, location in enumerate(st.session_state.locations, start=0):
             with cols[i % 5]:
-                if st.checkbox(location_names[location]):
+                if st.checkbox(location_names.get(location, location)):
                     locations.append(location)
 
-        # Filter the dataframe for the selected locations
-        if locations:
-            expenses_df = expenses_df.filter(pl.col('meter_id').is_in(locations))
-        else:
-            expenses_df = pl.DataFrame()
-
-        # Convert to pandas before drawing line chart
-        expenses_df = expenses_df.to_pandas()
-
-        if not expenses_df.empty:
-            # Pivot the dataframe to have a column for each location's expenses
-            expenses_pivot_df = expenses_df.pivot_table(index='ts', columns='meter_id',
-                                                                  values='expenses')
-            # Rename the columns to include the location names
-            expenses_pivot_df.rename(columns=location_names, inplace=True)
-        else:
-            expenses_pivot_df = pd.DataFrame()
+        # Each location's expenses are computed once and then kept in the result cache
+        with stage('compute') as record:
+            expenses = self.cached_columns(sorted(locations),
+                                           lambda missing: self.compute_expenses(start, end, missing),
+                                           start, end, 'hourly', 'expenses')
+            expenses = [location_df for location_df in expenses if not location_df.is_empty()]
+
+            if expenses:
+                # Join the locations to have a column for each location's expenses
+                expenses_pivot_df = functools.reduce(
+                    lambda left, right: left.join(right, on='ts', how='full', coalesce=True), expenses).sort('ts')
+            else:
+                expenses_pivot_df = pl.DataFrame()
+            record.output(expenses_pivot_df)
 
         return expenses_pivot_df
 
     # Plots expenses (power * price) for individual meter_id and plots their total expenses.
     # Calculates the total cost for the chosen meters
+    @profiled('expenses_line_chart')
     def expenses_line_chart(self, start, end):
         expenses_df = self.prepare_expenses_df(start, end)
 
@@ -301,102 +774,158 @@ class DataAnalyzer:
             st.button('Click here to see expenses line charts', on_click=callback_expenses)
         if st.session_state.expenses_button_clicked:
             # Check if there are any selected locations
-            if expenses_df.empty:
+            if expenses_df.is_empty():
                 st.write("No data available for the selected time range.")
                 return
             else:
                 lines = [col for col in expenses_df.columns if col != 'ts']
                 if len(lines) > 0:
-                    # Keep only positive values for the expenses
-                    #expenses_df[lines] = expenses_df[lines].where(expenses_df[lines] >= 0)
-
-                    # Get hourly values
-                    hourly_df = get_hourly_values(expenses_df)
+                    with stage('hourly_values', rows_in=expenses_df.height) as record:
+                        # Get hourly values
+                        hourly_df = get_hourly_values(expenses_df)
 
-                    # Add column for total expenses
-                    hourly_df['total_expenses'] = hourly_df[lines].sum(axis=1, skipna=True)
-                    hourly_df = to_helsinki_time(hourly_df)
+                        # Add column for total expenses
+                        hourly_df = record.output(
+                            hourly_df.with_columns(pl.sum_horizontal(lines).alias('total_expenses')))
 
                     # Calculate the total cost
                     cost = hourly_df['total_expenses'].sum()
 
                     # Draw the line chart
                     st.write(f'<h3>Net expenses (€/h)</h3', unsafe_allow_html=True)
-                    st.line_chart(hourly_df[lines])
+                    draw_line_chart(hourly_df, lines)
                     st.write(f'<h3>Total net expenses (€/h)</h3>', unsafe_allow_html=True)
-                    st.line_chart(hourly_df['total_expenses'])
+                    draw_line_chart(hourly_df, 'total_expenses')
                     st.write(f'<h4>Total cost of electricity during {start} - {end}:</h4>', unsafe_allow_html=True)
                     st.write(f'<h4>{cost:.2f} €</h4>', unsafe_allow_html=True)
                 else:
                     st.write('Choose columns to draw line chart')
 
+    # Returns the normalized hourly cost-effectiveness lines and the total cost, profit and net cost of all meters
+    def compute_cost_effectiveness(self, start, end):
+        range_df = self.query(None, start, end,
+                              ['expenses', 'expenses_positive', 'expenses_negative', 'total_active_power', 'price'],
+                              'hourly', ('mean', 'count'))
+        if range_df.is_empty():
+            return None
+        # One aggregation over all meters for every hour:
+        # positive expenses, profits (negative expenses), net expenses and cost-effectiveness (power / price)
+        ratio_hourly_df = (range_df.group_by('ts')
+                           .agg(pl.col('expenses_positive_mean').sum().alias('total_expenses'),
+                                (pl.col('expenses_negative_mean').sum() * (-1)).alias('total_profit'),
+                                pl.col('expenses_mean').sum().alias('net_expenses'),
+                                (weighted_mean('total_active_power') / weighted_mean('price'))
+                                .alias('power_to_price_ratio'))
+                           .sort('ts')
+                           .upsample('ts', every='1h')
+                           .with_columns(pl.col(['total_expenses', 'total_profit', 'net_expenses']).fill_null(0)))
+
+        cost = ratio_hourly_df['total_expenses'].sum()  # Total expenses
+        profit = ratio_hourly_df['total_profit'].sum()  # Total profit
+        real_cost = ratio_hourly_df['net_expenses'].sum()  # Total net expenses
+
+        # Normalize the lines for line chart
+        normalized_lines = ['total_expenses', 'total_profit', 'power_to_price_ratio']
+        ratio_hourly_df = ratio_hourly_df.with_columns([
+            pl.when(pl.col(line).is_infinite()).then(None).otherwise(pl.col(line)).fill_nan(0).fill_null(0).alias(line)
+            for line in normalized_lines])
+        ratio_hourly_df = ratio_hourly_df.with_columns([
+            min_max_scale(pl.col(line), pl.col(line).min(), pl.col(line).max()).alias(line)
+            for line in normalized_lines])
+        return ratio_hourly_df, cost, profit, real_cost
+
     # Plots Cost-effectiveness (power / price) and expenses (power * price)
     # Calculates the total cost for all meters
+    @profiled('cost_effectiveness')
     def cost_effectiveness(self, start, end):
-        # Expenses dataframe (power * price)
-        cost_df = self.dataframe.filter((pl.col('ts') >= start) & (pl.col('ts') < end)).to_pandas()
-        cost_df['ts'] = pd.to_datetime(cost_df['ts'])
-        cost_df.set_index('ts', inplace=True)
-
-        if cost_df.empty:
+        with stage('compute') as record:
+            result, = self.cached_columns(
+                ['cost_effectiveness'],
+                lambda missing: {'cost_effectiveness': self.compute_cost_effectiveness(start, end)},
+                start, end, 'hourly')
+            record.output(result)
+
+        if result is None:
             st.write("No data available for the selected time range.")
             return
         else:
-            # Pivot the dataframe to have a column for each location's expenses
-            cost_pivot_df = cost_df.pivot_table(index='ts', columns='meter_id', values='expenses')
-
-            lines = [col for col in cost_pivot_df.columns if col != 'ts']
-
-            # Keep only negative values for the profits
-            profitability_df = cost_pivot_df[lines].where(cost_pivot_df[lines] < 0)
-            profitability_hourly_df = get_hourly_values(profitability_df)
-            profitability_hourly_df['total_profit'] = profitability_hourly_df[lines].sum(axis=1, skipna=True)
-            profitability_hourly_df['total_profit'] = profitability_hourly_df['total_profit'] * (-1)
-            profit = profitability_hourly_df['total_profit'].sum()  # Total expenses
-
-            cost_hourly_df = get_hourly_values(cost_pivot_df)
-            cost_hourly_df['total_expenses'] = cost_hourly_df[lines].sum(axis=1, skipna=True)
-            real_cost = cost_hourly_df['total_expenses'].sum()  # Total expenses
-
-            # Keep only positive values for the expenses
-            cost_pivot_df[lines] = cost_pivot_df[lines].where(cost_pivot_df[lines] >= 0)
-            cost_hourly_df = get_hourly_values(cost_pivot_df)
-            cost_hourly_df['total_expenses'] = cost_hourly_df[lines].sum(axis=1, skipna=True)
-            cost = cost_hourly_df['total_expenses'].sum()  # Total expenses
-
-            # Create Cost-effectiveness dataframe (power / price)
-            ratio_df = self.dataframe.filter((pl.col('ts') >= start) & (pl.col('ts') < end)).select(
-                ['ts', 'total_active_power', 'price']).to_pandas()
-            ratio_df['ts'] = pd.to_datetime(ratio_df['ts'])
-            ratio_df.set_index('ts', inplace=True)
-
-            # Get hourly values
-            ratio_hourly_df = get_hourly_values(ratio_df)
-
-            # Make column for Cost-effectiveness (power / price)
-            ratio_hourly_df['power_to_price_ratio'] = ratio_hourly_df['total_active_power'] / ratio_hourly_df['price']
-
-            # Merge all the dataframes on the timestamp column
-            ratio_hourly_df = pd.merge(ratio_hourly_df, cost_hourly_df[['total_expenses']], left_index=True,
-                                       right_index=True)
-            ratio_hourly_df = pd.merge(ratio_hourly_df, profitability_hourly_df[['total_profit']], left_index=True,
-                                       right_index=True)
-
-            # Normalize the lines for line chart
-            scaler = MinMaxScaler()
+            ratio_hourly_df, cost, profit, real_cost = result
             normalized_lines = ['total_expenses', 'total_profit', 'power_to_price_ratio']
-            ratio_hourly_df.replace([np.inf, -np.inf], np.nan, inplace=True)
-            ratio_hourly_df[normalized_lines] = ratio_hourly_df[normalized_lines].fillna(0)
-            ratio_hourly_df[normalized_lines] = scaler.fit_transform(ratio_hourly_df[normalized_lines])
-            ratio_hourly_df = to_helsinki_time(ratio_hourly_df)
 
             # Draw the line chart
             st.write(f'<h2>Profitability and Expenses</h2>', unsafe_allow_html=True)
-            st.line_chart(ratio_hourly_df[normalized_lines])
+            draw_line_chart(ratio_hourly_df, normalized_lines)
             st.write(f'<h3>Overview of Electricity Expenses for {start} - {end}:</h3>', unsafe_allow_html=True)
             st.write(f'<h5>Total from Hourly Expenses: {cost:.2f} €</h5>', unsafe_allow_html=True)
             st.write(f'<h5>Total from Hourly Profit: {profit:.2f} €</h5>', unsafe_allow_html=True)
             st.write(f'<h5>Total Cost: {real_cost:.2f} €</h5>', unsafe_allow_html=True)
             st.write(f'<h5></h5>', unsafe_allow_html=True)
             st.write(f'<h5>Calculation:</h5>', unsafe_allow_html=True)
-            st.write(f'<h5>{cost:.2f} - {profit:.2f} = {(cost - profit):.2f} ≈ {real_cost:.2f} €</h5>', unsafe_allow_html=True)
\ No newline at end of file
+            st.write(f'<h5>{cost:.2f} - {profit:.2f} = {(cost - profit):.2f} ≈ {real_cost:.2f} €</h5>', unsafe_allow_html=True)
+
+    # Coverage of every meter from the sampling table, the gap index and the daily rollup, no rows are read.
+    # Coverage is the time covered by the readings, each standing for one sampling interval
+    @profiled('data_availability')
+    def data_availability(self):
+        with stage('compute') as record:
+            interval = pl.col('interval').dt.total_microseconds()
+            gap_totals = self.gap_index.group_by('meter_id').agg(
+                pl.len().alias('gaps'),
+                pl.col('duration').max().alias('longest_gap'),
+                pl.col('duration').sum().alias('gap_time'))
+            availability = self.sampling.join(gap_totals, on='meter_id', how='left').select(
+                pl.col('meter_id').cast(pl.String).replace(location_names).alias('location'),
+                'meter_id', 'interval', 'first_ts', 'last_ts', 'readings',
+                (100 * pl.col('readings') * interval
+                 / ((pl.col('last_ts') - pl.col('first_ts')).dt.total_microseconds() + interval))
+                .clip(upper_bound=100).alias('coverage_%'),
+                pl.col('gaps').fill_null(0), 'longest_gap', 'gap_time')
+            # An empty dataset has no days to make the coverage grid from
+            if availability.is_empty():
+                st.write("No data available in the dataset.")
+                return
+
+            # Days without readings have zero coverage
+            days = self.daily_rollup['ts'].dt.date()
+            grid = availability.select(['meter_id', 'location']).join(
+                pl.date_range(days.min(), days.max(), '1d', eager=True).alias('day').to_frame(), how='cross')
+            daily = self.daily_rollup.join(self.sampling.select(['meter_id', 'interval']), on='meter_id').select(
+                'meter_id', pl.col('ts').dt.date().alias('day'),
+                (100 * pl.col('rows') * interval / 86400000000).clip(upper_bound=100).alias('coverage'))
+            daily_coverage = record.output(grid.join(daily, on=['meter_id', 'day'], how='left')
+                                           .with_columns(pl.col('coverage').fill_null(0))
+                                           .sort(['meter_id', 'day']))
+
+        st.write('<h3>Data availability of each meter</h3>', unsafe_allow_html=True)
+        st.dataframe(availability, hide_index=True)
+        st.write('<h3>Daily coverage (%)</h3>', unsafe_allow_html=True)
+        with stage('render'):
+            st.plotly_chart(availability_figure(daily_coverage), theme="streamlit")
+
+    # Cost, profit, net cost and consumption of every meter for every day, ISO week or month of the dataset,
+    # with the change from the previous period. The report is built from the hourly rollup and cached by period
+    @profiled('expense_report')
+    def expense_report(self):
+        period = st.radio('Select period', list(REPORT_PERIODS), horizontal=True)
+        with stage('compute') as record:
+            report, = self.cached_columns([period], lambda missing: {
+                period: build_period_report(self.hourly_rollup, period) for period in missing}, 'expense_report')
+            record.output(report)
+
+        if report.is_empty():
+            st.write("No data available in the dataset.")
+            return
+
+        st.write(f'<h3>Expenses of each meter by {period.lower()}</h3>', unsafe_allow_html=True)
+        st.dataframe(report, hide_index=True)
+
+        # Net cost of every meter as columns for every period as rows
+        st.write(f'<h3>Net cost by {period.lower()} (€)</h3>', unsafe_allow_html=True)
+        st.dataframe(report.pivot('location', index='period', values='net_cost', sort_columns=True)
+                     .sort('period'), hide_index=True)
+
+        buffer = io.BytesIO()
+        report.write_parquet(buffer)
+        st.download_button(label="Download report as Parquet file", data=buffer.getvalue(),
+                           file_name=f'expense_report_{period.lower().replace(" ", "_")}.parquet',
+                           mime="application/octet-stream")
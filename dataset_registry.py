@@ -0,0 +1,87 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+
+# The L and Total analyzers of one uploaded file. They are shared by every session that uses the file,
+# so nothing in them may be modified after they are built
+class Dataset:
+    def __init__(self, fingerprint, analyzer_L, analyzer_total, locations):
+        self.fingerprint = fingerprint
+        self.analyzer_L = analyzer_L
+        self.analyzer_total = analyzer_total
+        self.locations = locations
+        self.refcount = 0
+        self.last_used = time.time()
+
+    # Size of the in-memory tables, the datasets themselves stay on disk
+    def estimated_size(self):
+        size = 0
+        for analyzer in (self.analyzer_L, self.analyzer_total):
+            size += analyzer.hourly_rollup.estimated_size() + analyzer.daily_rollup.estimated_size()
+            size += analyzer.sampling.estimated_size() + analyzer.gap_index.estimated_size()
+        return size
+
+
+# A session's handle to a shared dataset. The dataset is released when the handle is garbage collected,
+# which happens when the session state is dropped
+class DatasetView:
+    def __init__(self, registry, dataset):
+        self.fingerprint = dataset.fingerprint
+        self.analyzer_L = dataset.analyzer_L
+        self.analyzer_total = dataset.analyzer_total
+        self.locations = dataset.locations
+        weakref.finalize(self, registry.release, dataset.fingerprint)
+
+
+# Process-wide registry of datasets keyed by the content hash of the uploaded file.
+# Datasets that no session uses are evicted, least recently used first, when the registry is over its memory budget
+class DatasetRegistry:
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.datasets = OrderedDict()
+        self.lock = threading.Lock()
+        self.build_locks = {}
+
+    # Returns a view of the dataset, building it with build() if it isn't in the registry yet.
+    # Sessions uploading the same file at the same time wait for one build
+    def acquire(self, fingerprint, build):
+        with self.lock:
+            build_lock = self.build_locks.setdefault(fingerprint, threading.Lock())
+
+        with build_lock:
+            with self.lock:
+                dataset = self.datasets.get(fingerprint)
+            if dataset is None:
+                dataset = build()
+
+            with self.lock:
+                self.datasets[fingerprint] = dataset
+                self.datasets.move_to_end(fingerprint)
+                dataset.refcount += 1
+                dataset.last_used = time.time()
+                self.build_locks.pop(fingerprint, None)
+                self.evict()
+        return DatasetView(self, dataset)
+
+    def release(self, fingerprint):
+        with self.lock:
+            dataset = self.datasets.get(fingerprint)
+            if dataset is not None:
+                dataset.refcount -= 1
+                self.evict()
+
+    def memory_usage(self):
+        return sum(dataset.estimated_size() for dataset in self.datasets.values())
+
+    # Must be called with the lock held
+    def evict(self):
+        usage = self.memory_usage()
+        for fingerprint in list(self.datasets):
+            if usage <= self.memory_budget:
+                break
+            dataset = self.datasets[fingerprint]
+            if dataset.refcount <= 0:
+                usage -= dataset.estimated_size()
+                del self.datasets[fingerprint]
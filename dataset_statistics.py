@@ -0,0 +1,171 @@
+import numpy as np
+import polars as pl
+
+# Rows of the dataset read at a time when the statistics are computed
+BATCH_ROWS = 500000
+
+# Rows of a summary, in the order of polars' describe()
+STATISTICS = ['count', 'null_count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+QUANTILES = [0.25, 0.5, 0.75]
+
+
+# Count, null count, mean, sum of squared differences from the mean, minimum and maximum of a column.
+# Batches and meters are merged with the pairwise formula of Chan et al., so the mean and std stay accurate
+# without a second pass over the data
+class Moments:
+    def __init__(self, count=0, null_count=0, mean=0.0, m2=0.0, minimum=None, maximum=None):
+        self.count = count
+        self.null_count = null_count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    # Moments of a column from a row of batch_aggregations
+    @classmethod
+    def from_row(cls, row, col):
+        count = row[f'{col}_count']
+        if count == 0:
+            return cls(null_count=row[f'{col}_null_count'])
+        return cls(count, row[f'{col}_null_count'], row[f'{col}_mean'], row[f'{col}_var'] * count,
+                   row[f'{col}_min'], row[f'{col}_max'])
+
+    def merge(self, other):
+        self.null_count += other.null_count
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.minimum, self.maximum = other.minimum, other.maximum
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    # Sample standard deviation, like polars' std()
+    def std(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else None
+
+
+# Mergeable quantile sketch in the style of KLL. Values are kept in levels where a value on level h stands for
+# 2**h values of the column. When a level has more than k values, they are sorted and every other value,
+# starting from a random one, moves up a level. A large batch is compacted straight to level h: it is sorted
+# and every 2**h-th value, starting from a random one, is added on level h, which is what h compactions of the
+# sorted batch would keep
+class QuantileSketch:
+    def __init__(self, k=512, rng=None):
+        self.k = k
+        self.levels = []
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        level = max(0, int(np.ceil(np.log2(len(values) / self.k))))
+        if level:
+            # The shorter last block keeps its value with the probability of its share of a full block
+            block = 2 ** level
+            values = np.sort(values)[self.rng.integers(block)::block]
+        self.add(level, values)
+
+    def add(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(np.empty(0))
+        self.levels[level] = np.concatenate([self.levels[level], values])
+        self.compact()
+
+    def compact(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.k:
+                values = np.sort(values)
+                # With an odd number of values, a random one stays on the level
+                stay = np.empty(0)
+                if len(values) % 2:
+                    index = self.rng.integers(len(values))
+                    stay = values[index:index + 1]
+                    values = np.delete(values, index)
+                self.levels[level] = stay
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1],
+                                                         values[self.rng.integers(2)::2]])
+            level += 1
+
+    def merge(self, other):
+        for level, values in enumerate(other.levels):
+            while len(self.levels) <= level:
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.compact()
+
+    # Approximate values at the quantiles qs, None for each when the sketch is empty
+    def quantiles(self, qs):
+        values = np.concatenate(self.levels) if self.levels else np.empty(0)
+        if len(values) == 0:
+            return [None] * len(qs)
+        weights = np.concatenate([np.full(len(level_values), 2.0 ** level)
+                                  for level, level_values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        ranks = np.searchsorted(cumulative, np.asarray(qs) * cumulative[-1], side='left')
+        return values[order][np.minimum(ranks, len(values) - 1)].tolist()
+
+
+# Count, null count, mean, variance, minimum and maximum of the columns in one select
+def batch_aggregations(columns):
+    return [expression for col in columns for expression in (
+        pl.col(col).count().alias(f'{col}_count'),
+        pl.col(col).null_count().alias(f'{col}_null_count'),
+        pl.col(col).cast(pl.Float64).mean().alias(f'{col}_mean'),
+        pl.col(col).cast(pl.Float64).var(ddof=0).alias(f'{col}_var'),
+        pl.col(col).cast(pl.Float64).min().alias(f'{col}_min'),
+        pl.col(col).cast(pl.Float64).max().alias(f'{col}_max'))]
+
+
+def summary_row(meter, moments, sketch):
+    return [meter, moments.count, moments.null_count, moments.mean if moments.count else None, moments.std(),
+            moments.minimum, *sketch.quantiles(QUANTILES), moments.maximum]
+
+
+# Summary statistics of the numeric columns of dataframe, a LazyFrame with a meter_id column, in one streaming
+# pass of BATCH_ROWS rows at a time. Only the moments and sketches of each meter and column are kept in memory.
+# Returns a DataFrame for each column with the STATISTICS of each meter and a last row with a null meter_id
+# for all meters, which is merged from the meters' moments and sketches
+def describe_columns(dataframe, columns, batch_rows=BATCH_ROWS, seed=None):
+    rng = np.random.default_rng(seed)
+    moments = {}
+    sketches = {}
+    aggregations = batch_aggregations(columns)
+    for batch in dataframe.select(['meter_id', *columns]).collect_batches(chunk_size=batch_rows):
+        # The dataset is sorted by meter_id, so a batch has the rows of one or a few meters
+        for (meter,), meter_rows in batch.partition_by('meter_id', as_dict=True, maintain_order=True).items():
+            row = meter_rows.select(aggregations).row(0, named=True)
+            for col in columns:
+                moments.setdefault((meter, col), Moments()).merge(Moments.from_row(row, col))
+                sketches.setdefault((meter, col), QuantileSketch(rng=rng)).update(
+                    meter_rows[col].drop_nulls().to_numpy())
+
+    meters = list(dict.fromkeys(meter for meter, _ in moments))
+    schema = {'meter_id': dataframe.collect_schema()['meter_id'], 'count': pl.Int64, 'null_count': pl.Int64,
+              **{statistic: pl.Float64 for statistic in STATISTICS[2:]}}
+    summaries = {}
+    for col in columns:
+        rows = []
+        all_moments = Moments()
+        all_sketch = QuantileSketch(rng=rng)
+        for meter in meters:
+            rows.append(summary_row(meter, moments[meter, col], sketches[meter, col]))
+            all_moments.merge(moments[meter, col])
+            all_sketch.merge(sketches[meter, col])
+        rows.append(summary_row(None, all_moments, all_sketch))
+        summaries[col] = pl.DataFrame(rows, schema=schema, orient='row')
+    return summaries
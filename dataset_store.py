@@ -0,0 +1,319 @@
+import json
+import pathlib
+import re
+import shutil
+import threading
+import time
+import polars as pl
+from caching import content_hash
+from data_analyzer import build_gap_index, build_rollup, extend_gap_index, rollup_from_hourly
+from ingestion import empty_dataframes, ingest_parquet, meter_enum
+
+MANIFEST = 'manifest.json'
+DATASETS = ('L', 'Total')
+
+
+# Processed datasets on disk, one directory for each dataset name:
+#   <name>/manifest.json                         sources, partitions and rollups of the dataset
+#   <name>/<L|Total>/meter=<id>/month=<YYYY-MM>/part-<n>.parquet
+#   <name>/<L|Total>/hourly_rollup.parquet
+#   <name>/<L|Total>/sampling.parquet, gap_index.parquet  sampling interval and gaps of each meter
+# The partitions are listed in the manifest in meter_id and month order, so scanning them in that order gives
+# the rows sorted by meter_id and ts. A stored dataset is opened from its manifest and rollups without reading the data.
+# Partition files are never rewritten: an append writes new parts and lists the files they replace as superseded
+# in the manifest. Analyzers opened before the append still scan those files, so they are removed only when
+# the store is opened again after a restart
+class DatasetStore:
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.ingest_locks = {}
+        for name in self.names():
+            self.remove_superseded(name)
+
+    def names(self):
+        return sorted(path.parent.name for path in self.root.glob(f'*/{MANIFEST}'))
+
+    def read_manifest(self, name):
+        return json.loads((self.root / name / MANIFEST).read_text())
+
+    # The manifest is replaced in one step, so a dataset is never seen half written
+    def write_manifest(self, name, manifest):
+        temp_path = self.root / name / f'{MANIFEST}.tmp'
+        temp_path.write_text(json.dumps(manifest, indent=2))
+        temp_path.replace(self.root / name / MANIFEST)
+
+    # Removes the partition files that appends have replaced
+    def remove_superseded(self, name):
+        manifest = self.read_manifest(name)
+        if manifest.get('superseded'):
+            for path in manifest['superseded']:
+                (self.root / name / path).unlink(missing_ok=True)
+            manifest['superseded'] = []
+            self.write_manifest(name, manifest)
+
+    # Lock of the file with the fingerprint, so sessions uploading the same file at the same time wait for one ingest.
+    # setdefault is atomic, so the same lock is returned to every session
+    def ingest_lock(self, fingerprint):
+        return self.ingest_locks.setdefault(fingerprint, threading.Lock())
+
+    # Returns the name of the stored dataset that the file with the fingerprint was ingested into
+    def find(self, fingerprint):
+        for name in self.names():
+            if any(source['fingerprint'] == fingerprint for source in self.read_manifest(name)['sources']):
+                return name
+        return None
+
+    # Dataset name from a file name, with a number added when the name is taken
+    def unique_name(self, file_name):
+        base = re.sub(r'[^\w.-]+', '_', pathlib.Path(file_name).stem).strip('._') or 'dataset'
+        name = base
+        number = 2
+        while (self.root / name).exists():
+            name = f'{base}_{number}'
+            number += 1
+        return name
+
+    # Processes the parquet file at path into a new stored dataset and returns its manifest
+    def ingest(self, name, path, fingerprint, file_name, progress=None):
+        dataset_dir = self.root / name
+        try:
+            partitions, hourly_rollups, sizes = ingest_parquet(path, dataset_dir, progress)
+            datasets = {}
+            for dataset in DATASETS:
+                rollup_path = pathlib.Path(dataset) / 'hourly_rollup.parquet'
+                hourly_rollups[dataset].write_parquet(dataset_dir / rollup_path)
+                datasets[dataset] = {
+                    'partitions': partitions[dataset],
+                    'hourly_rollup': str(rollup_path),
+                    'rows': sum(partition['rows'] for partition in partitions[dataset]),
+                    'memory_before': sizes[dataset][0],
+                    'memory_after': sizes[dataset][1],
+                }
+
+            manifest = {
+                'name': name,
+                'fingerprint': fingerprint,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'sources': [{'fingerprint': fingerprint, 'file_name': file_name}],
+                'datasets': datasets,
+            }
+            for dataset in DATASETS:
+                self.write_gap_index(manifest, dataset)
+            self.write_manifest(name, manifest)
+        except Exception:
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+            raise
+        return manifest
+
+    # Lazy scan of a stored dataset's partitions in manifest order
+    def scan(self, manifest, dataset):
+        paths = [self.root / manifest['name'] / partition['path']
+                 for partition in manifest['datasets'][dataset]['partitions']]
+        return pl.scan_parquet(paths, hive_partitioning=False)
+
+    def hourly_rollup(self, manifest, dataset):
+        return pl.read_parquet(self.root / manifest['name'] / manifest['datasets'][dataset]['hourly_rollup'])
+
+    # Returns the sampling table and the gap index of a stored dataset.
+    # Datasets that were stored without them get them when they are first opened
+    def gap_index(self, manifest, dataset):
+        if 'gap_index' not in manifest['datasets'][dataset]:
+            with self.lock:
+                manifest = self.read_manifest(manifest['name'])
+                if 'gap_index' not in manifest['datasets'][dataset]:
+                    self.write_gap_index(manifest, dataset)
+                    self.write_manifest(manifest['name'], manifest)
+
+        entry = manifest['datasets'][dataset]
+        dataset_dir = self.root / manifest['name']
+        return pl.read_parquet(dataset_dir / entry['sampling']), pl.read_parquet(dataset_dir / entry['gap_index'])
+
+    # Finds the gaps of the meters, all meters when meters is None, from the stored partitions and writes the
+    # sampling table and the gap index of the dataset. The rows of other meters are kept from the stored files
+    def write_gap_index(self, manifest, dataset, meters=None):
+        entry = manifest['datasets'][dataset]
+        dataset_dir = self.root / manifest['name']
+        # Without a stored gap index the gaps of all meters are searched
+        meters = meters if 'gap_index' in entry else None
+        sampling, gap_index = build_gap_index(self.scan(manifest, dataset), self.hourly_rollup(manifest, dataset),
+                                              meters)
+        if meters is not None:
+            other_meters = ~pl.col('meter_id').is_in(list(meters))
+            sampling = pl.concat([pl.read_parquet(dataset_dir / entry['sampling']).filter(other_meters),
+                                  sampling]).sort('meter_id')
+            gap_index = pl.concat([pl.read_parquet(dataset_dir / entry['gap_index']).filter(other_meters),
+                                   gap_index]).sort(['meter_id', 'start'])
+
+        entry['sampling'] = str(pathlib.Path(dataset) / 'sampling.parquet')
+        entry['gap_index'] = str(pathlib.Path(dataset) / 'gap_index.parquet')
+        write_parquet_file(sampling, dataset_dir / entry['sampling'])
+        write_parquet_file(gap_index, dataset_dir / entry['gap_index'])
+
+    # Updates the sampling table and the gap index of the dataset with the added rows. The gaps after the stored
+    # rows are found from the added rows and the stored last reading of each meter, so an append of a new day
+    # doesn't read the stored rows. Only the meters with rows added inside their stored range are searched again
+    def extend_gap_index(self, manifest, dataset, added_rows):
+        entry = manifest['datasets'][dataset]
+        if 'gap_index' not in entry:
+            self.write_gap_index(manifest, dataset)
+            return
+
+        dataset_dir = self.root / manifest['name']
+        sampling, gap_index, rescan = extend_gap_index(pl.read_parquet(dataset_dir / entry['sampling']),
+                                                       pl.read_parquet(dataset_dir / entry['gap_index']),
+                                                       added_rows)
+        write_parquet_file(sampling, dataset_dir / entry['sampling'])
+        write_parquet_file(gap_index, dataset_dir / entry['gap_index'])
+        if rescan:
+            self.write_gap_index(manifest, dataset, rescan)
+
+    # Appends the rows of a new export at path to a stored dataset. The export must have the same columns as the
+    # dataset and rows whose (meter_id, ts) are already stored are dropped. Only the meters and months of the export
+    # are touched and the hourly rollups are updated from the added rows.
+    # Returns the updated manifest and the number of rows added to the Total values
+    def append(self, name, path, fingerprint, file_name, progress=None):
+        import pyarrow.parquet as pq
+
+        with self.lock:
+            manifest = self.read_manifest(name)
+            if any(source['fingerprint'] == fingerprint for source in manifest['sources']):
+                return manifest, 0
+
+            # Meters that aren't in the dataset yet are added at the end of its meter_id Enum
+            parquet_file = pq.ParquetFile(path)
+            stored_type = self.scan(manifest, 'Total').collect_schema()['meter_id']
+            stored_meters = stored_type.categories.to_list()
+            new_meters = [meter for meter in meter_enum(parquet_file).categories.to_list()
+                          if meter not in stored_meters]
+            meter_type = pl.Enum(stored_meters + new_meters)
+
+            try:
+                export_schemas = {dataset: df.schema
+                                  for dataset, df in empty_dataframes(parquet_file, meter_type).items()}
+            except pl.exceptions.ColumnNotFoundError as error:
+                raise ValueError(f"{file_name} is missing a column: {error}") from error
+            for dataset, export_schema in export_schemas.items():
+                stored_schema = self.scan(manifest, dataset).collect_schema()
+                if export_schema.names() != stored_schema.names() or any(
+                        dtype != stored_schema[col] for col, dtype in export_schema.items() if col != 'meter_id'):
+                    raise ValueError(f"The columns of {file_name} don't match the {dataset} values of {name}")
+
+            if new_meters:
+                self.cast_meters(manifest, meter_type)
+
+            dataset_dir = self.root / name
+            export_dir = dataset_dir / 'append'
+            shutil.rmtree(export_dir, ignore_errors=True)
+            rows_added = {}
+            try:
+                export_partitions, _, _ = ingest_parquet(path, export_dir, progress, meter_type)
+                for dataset in DATASETS:
+                    entry = manifest['datasets'][dataset]
+                    added = self.merge_partitions(manifest, dataset, export_dir, export_partitions[dataset],
+                                                  meter_type)
+                    rows_added[dataset] = sum(rows.height for rows in added)
+                    if added:
+                        # Hours that already had rows are merged with the rollup of the added rows
+                        hourly_rollup = self.hourly_rollup(manifest, dataset)
+                        hourly_rollup = pl.concat([hourly_rollup, build_rollup(pl.concat(added).lazy(), '1h')
+                                                  .select(hourly_rollup.columns).cast(dict(hourly_rollup.schema))])
+                        hourly_rollup = rollup_from_hourly(hourly_rollup.sort(['meter_id', 'ts']), '1h')
+                        write_parquet_file(hourly_rollup, dataset_dir / entry['hourly_rollup'])
+
+                        self.extend_gap_index(manifest, dataset, pl.concat(added))
+                    entry['rows'] = sum(partition['rows'] for partition in entry['partitions'])
+            finally:
+                shutil.rmtree(export_dir, ignore_errors=True)
+
+            manifest['fingerprint'] = content_hash(manifest['fingerprint'], fingerprint)
+            manifest['sources'].append({'fingerprint': fingerprint, 'file_name': file_name})
+            self.write_manifest(name, manifest)
+            return manifest, rows_added['Total']
+
+    # Moves the partitions of an ingested export into the dataset and returns the rows that were added.
+    # Rows after the end of a stored meter and month are added as a new part file. When rows fall inside
+    # the stored time range, the meter and month is rewritten as one file with the new rows in ts order
+    def merge_partitions(self, manifest, dataset, export_dir, export_partitions, meter_type):
+        dataset_dir = self.root / manifest['name']
+        partitions = manifest['datasets'][dataset]['partitions']
+        added = []
+        for export_partition in export_partitions:
+            if export_partition['rows'] == 0:
+                continue
+
+            meter, month = export_partition['meter_id'], export_partition['month']
+            rows = pl.read_parquet(export_dir / export_partition['path']).unique('ts', keep='first',
+                                                                                  maintain_order=True)
+            stored = [partition for partition in partitions
+                      if partition['meter_id'] == meter and partition['month'] == month]
+            part, path = new_part(dataset, partitions, meter, month)
+            (dataset_dir / path).parent.mkdir(parents=True, exist_ok=True)
+
+            if stored:
+                stored_rows = pl.scan_parquet([dataset_dir / partition['path'] for partition in stored],
+                                              hive_partitioning=False)
+                last_ts = stored_rows.select(pl.col('ts').max()).collect().item()
+                if rows['ts'].min() <= last_ts:
+                    stored_rows = stored_rows.collect()
+                    rows = rows.join(stored_rows.select('ts'), on='ts', how='anti')
+                    if rows.is_empty():
+                        continue
+                    merged = pl.concat([stored_rows, rows]).sort('ts', maintain_order=True)
+                    write_parquet_file(merged, dataset_dir / path)
+                    for partition in stored:
+                        partitions.remove(partition)
+                        manifest.setdefault('superseded', []).append(partition['path'])
+                    partitions.append({'meter_id': meter, 'month': month, 'part': part, 'path': str(path),
+                                       'rows': merged.height})
+                    added.append(rows)
+                    continue
+
+            write_parquet_file(rows, dataset_dir / path)
+            partitions.append({'meter_id': meter, 'month': month, 'part': part, 'path': str(path),
+                               'rows': rows.height})
+            added.append(rows)
+
+        # Scanning the partitions in this order gives the rows sorted by meter_id and ts
+        meters = meter_type.categories.to_list()
+        partitions.sort(key=lambda partition: (meters.index(partition['meter_id'])
+                                               if partition['meter_id'] in meters else len(meters),
+                                               partition['month'] or '', partition.get('part', 0)))
+        return added
+
+    # Rewrites the partitions and rollups of a dataset with a meter_id Enum that has new meters at the end.
+    # The stored meters keep their order, so the partitions stay sorted. Each partition is written as a new part
+    # numbered after the existing ones, so the order of the parts is kept too
+    def cast_meters(self, manifest, meter_type):
+        dataset_dir = self.root / manifest['name']
+        for dataset in DATASETS:
+            entry = manifest['datasets'][dataset]
+            for partition in list(entry['partitions']):
+                df = pl.read_parquet(dataset_dir / partition['path']).with_columns(pl.col('meter_id').cast(meter_type))
+                part, path = new_part(dataset, entry['partitions'], partition['meter_id'], partition['month'])
+                write_parquet_file(df, dataset_dir / path)
+                manifest.setdefault('superseded', []).append(partition['path'])
+                entry['partitions'][entry['partitions'].index(partition)] = {**partition, 'part': part,
+                                                                             'path': str(path)}
+
+            # The rollups and gap indexes are read into memory when a dataset is opened, so they are replaced
+            for path in [entry[index] for index in ('hourly_rollup', 'sampling', 'gap_index') if index in entry]:
+                df = pl.read_parquet(dataset_dir / path).with_columns(pl.col('meter_id').cast(meter_type))
+                write_parquet_file(df, dataset_dir / path)
+
+
+# Number and path of a new part of a meter and month, after the parts that are in partitions
+def new_part(dataset, partitions, meter, month):
+    part = max((partition.get('part', 0) for partition in partitions
+                if partition['meter_id'] == meter and partition['month'] == month), default=-1) + 1
+    if meter is None:
+        return part, pathlib.Path(dataset) / f'empty-{part}.parquet'
+    return part, pathlib.Path(dataset) / f'meter={meter}' / f'month={month}' / f'part-{part}.parquet'
+
+
+# Writes df to a temporary file first, so a file that is being replaced is never seen half written
+def write_parquet_file(df, path):
+    temp_path = path.with_name(f'{path.name}.tmp')
+    df.write_parquet(temp_path)
+    temp_path.replace(path)
@@ -0,0 +1,72 @@
+import numpy as np
+import polars as pl
+
+CHART_WIDTH = 1200  # Width of a chart in pixels in the wide layout
+POINTS_PER_PIXEL = 2  # The minimum and the maximum of each pixel column
+
+
+# Number of points per series that a chart can show
+def point_budget(chart_width=CHART_WIDTH):
+    return chart_width * POINTS_PER_PIXEL
+
+
+# First and last rows, and rows where a series becomes null. They are always kept so interruptions stay visible
+def edge_rows(df, columns):
+    missing = [pl.col(col).fill_nan(None).is_null() for col in columns]
+    starts_gap = pl.any_horizontal([is_missing & ~is_missing.shift(1, fill_value=True) for is_missing in missing])
+    rows = df.with_row_index('row_nr').filter(starts_gap)['row_nr'].to_numpy()
+    return np.concatenate([rows, [0, df.height - 1]])
+
+
+# Splits the rows into buckets and keeps the rows of each series' minimum and maximum in every bucket
+def min_max_rows(df, columns, n_buckets):
+    buckets = df.with_row_index('row_nr').with_columns((pl.col('row_nr') * n_buckets // df.height).alias('bucket'))
+    picked = buckets.group_by('bucket').agg(
+        [pl.col('row_nr').get(pl.col(col).arg_min()).alias(f'{col}_min') for col in columns]
+        + [pl.col('row_nr').get(pl.col(col).arg_max()).alias(f'{col}_max') for col in columns])
+    return picked.drop('bucket').unpivot()['value'].drop_nulls().to_numpy()
+
+
+# Largest-Triangle-Three-Buckets: picks n_out points of the series that keep its visual shape
+def lttb_rows(x, y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # The first and last points are always kept, the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    rows = np.empty(n_out, dtype=np.int64)
+    rows[0] = 0
+    rows[-1] = n - 1
+
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        average_x = x[end:next_end].mean()
+        average_y = np.nanmean(y[end:next_end]) if np.any(~np.isnan(y[end:next_end])) else y[previous]
+
+        # Area of the triangle formed by the previous point, each candidate and the average of the next bucket
+        area = np.abs((x[previous] - average_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (average_y - y[previous]))
+        previous = start + int(np.argmax(np.nan_to_num(area, nan=-1.0)))
+        rows[i + 1] = previous
+    return rows
+
+
+# Reduces the rows of df to about max_points per series for drawing. method is 'minmax' or 'lttb'.
+# The x-axis (ts) is shared, so the rows picked for each series are kept for all of them
+def downsample(df, columns, max_points, method='minmax'):
+    if df.height <= max_points or not columns:
+        return df
+
+    rows = [edge_rows(df, columns)]
+    if method == 'lttb':
+        x = df['ts'].to_physical().to_numpy().astype(np.float64)
+        for col in columns:
+            y = df[col].cast(pl.Float64).to_numpy()
+            rows.append(lttb_rows(x, y, max(3, max_points // len(columns))))
+    else:
+        rows.append(min_max_rows(df, columns, max(1, max_points // (2 * len(columns)))))
+
+    return df[np.unique(np.concatenate(rows)).tolist()]
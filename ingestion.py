@@ -0,0 +1,206 @@
+import pathlib
+import shutil
+import polars as pl
+from data_analyzer import TIMEZONE, build_rollup, rollup_from_hourly
+from dictionaries import location_names
+
+# Sensors that are stored as float32, their precision doesn't need float64
+FLOAT32_SENSORS = ('voltage', 'current', 'power_factor', 'frequency')
+
+
+# Splits the columns of the uploaded file into total columns and L1, L2, L3 data columns
+def classify_columns(columns):
+    total_columns = []
+    data_columns = []
+    for col in columns:
+        if 'total' in col or 'Total' in col:
+            total_columns.append(col)
+        elif 'ts' not in col and 'meter_id' not in col and 'price' not in col:
+            data_columns.append(col)
+    return total_columns, data_columns
+
+
+# Naive timestamps are local time. Times that don't exist in local time (the hour skipped in spring) are shifted
+# forward by an hour, so the readings in it keep their spacing. The hour that repeats in autumn is taken as its
+# first occurrence until the timestamps of a meter go back within it, and from there on as its second occurrence,
+# so the readings of both passes keep their real time. ambiguous_seen maps each meter to its latest repeated-hour timestamp in the earlier
+# batches of the same file and is updated with this batch, so a pass that starts in a new batch is recognized.
+# Timestamps that already have a time zone are converted
+def localize_timestamps(df, ambiguous_seen=None):
+    if df.schema['ts'].time_zone is not None:
+        return df.with_columns(pl.col('ts').dt.convert_time_zone(TIMEZONE))
+
+    ambiguous_seen = ambiguous_seen if ambiguous_seen is not None else {}
+    earliest = pl.col('ts').dt.replace_time_zone(TIMEZONE, ambiguous='earliest', non_existent='null')
+    latest = pl.col('ts').dt.replace_time_zone(TIMEZONE, ambiguous='latest', non_existent='null')
+    ambiguous_ts = pl.when(earliest != latest).then(pl.col('ts'))
+
+    # Latest repeated-hour timestamp of the meter before each row, in file order
+    seen = pl.DataFrame({'meter_id': list(ambiguous_seen), 'ambiguous_seen': list(ambiguous_seen.values())},
+                        schema={'meter_id': df.schema['meter_id'], 'ambiguous_seen': df.schema['ts']})
+    df = df.join(seen, on='meter_id', how='left', maintain_order='left').with_columns(
+        pl.max_horizontal(ambiguous_ts.cum_max().forward_fill().shift(1).over('meter_id'),
+                          pl.col('ambiguous_seen')).alias('ambiguous_seen'))
+
+    for meter, ts in (df.filter(ambiguous_ts.is_not_null()).group_by('meter_id')
+                      .agg(pl.col('ts').max()).iter_rows()):
+        ambiguous_seen[meter] = max(ts, ambiguous_seen.get(meter, ts))
+
+    shifted_ts = (pl.col('ts') + pl.duration(hours=1)).dt.replace_time_zone(
+        TIMEZONE, ambiguous='earliest', non_existent='null')
+    second_pass = ambiguous_ts.is_not_null() & (pl.col('ambiguous_seen') >= pl.col('ts'))
+    return df.with_columns(
+        pl.when(second_pass).then(latest).otherwise(earliest).fill_null(shifted_ts).alias('ts')
+    ).drop('ambiguous_seen')
+
+
+# Returns an Enum of the known meters and the other meters in the file, so meter_id is stored as integers.
+# Only the meter_id column of each row group is read
+def meter_enum(parquet_file):
+    meters = set()
+    for i in range(parquet_file.num_row_groups):
+        meters.update(pl.from_arrow(parquet_file.read_row_group(i, columns=['meter_id']))['meter_id'].unique()
+                      .drop_nulls().to_list())
+    return pl.Enum(list(location_names) + sorted(meters - set(location_names)))
+
+
+# Casts meter_id to meter_type and the sensors in FLOAT32_SENSORS to float32.
+# Energy counters, power, prices and expenses keep float64
+def compact_dtypes(df, meter_type):
+    return df.with_columns(
+        [pl.col('meter_id').cast(meter_type)]
+        + [pl.col(col).cast(pl.Float32) for col, dtype in df.schema.items()
+           if dtype.is_float() and col.endswith(FLOAT32_SENSORS)])
+
+
+# Empty L and Total dataframes with the schemas that the parquet file is processed into
+def empty_dataframes(parquet_file, meter_type):
+    total_columns, data_columns = classify_columns(parquet_file.schema_arrow.names)
+    datasets = process_batch(pl.from_arrow(parquet_file.schema_arrow.empty_table()), total_columns, data_columns)
+    return {name: compact_dtypes(df, meter_type) for name, df in datasets.items()}
+
+
+def rename_columns(df):
+    return df.rename({col: col.replace(' ', '_').lower() for col in df.columns})
+
+
+# Creates the L1, L2, L3 and the Total dataframes from one batch of the uploaded file.
+# ambiguous_seen is the state of localize_timestamps that is kept between the batches of a file
+def process_batch(df_all, total_columns, data_columns, ambiguous_seen=None):
+    # Rows without a timestamp can't be placed in the sorted datasets
+    df_all = localize_timestamps(df_all.filter(pl.col('ts').is_not_null()), ambiguous_seen)
+
+    # Remove negative prices
+    df_all = df_all.with_columns(
+        pl.when(pl.col('price') < 0)
+        .then(0)
+        .otherwise(pl.col('price'))
+        .alias('price')
+    )
+
+    df_L1_L2_L3 = rename_columns(df_all.drop(total_columns))
+    df_total = rename_columns(df_all.drop(data_columns))
+
+    # Prices are in EUR / MWh and total_active_power is in W, so divide by 1 000 000 to get EUR / h
+    df_total = df_total.with_columns(
+        ((pl.col('total_active_power') * pl.col('price'))/1000000).alias('expenses'))
+
+    return {'L': df_L1_L2_L3, 'Total': df_total}
+
+
+# Writes the rows of one processed row group to the spill files of their meter_id and month under spill_dir,
+# one file for each row group, in the schema of the dataset. The files are only read once, so they are not compressed.
+# Returns the (meter_id, month) of the files
+def spill_batch(df, schema, spill_dir, batch_index):
+    months = df.select(pl.col('ts').dt.strftime('%Y-%m').alias('month')).to_series()
+    keys = []
+    for (meter, month), rows in df.with_columns(months).partition_by(
+            'meter_id', 'month', as_dict=True, maintain_order=True).items():
+        path = spill_dir / f'meter={meter}' / f'month={month}' / f'batch-{batch_index}.parquet'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        rows.drop('month').cast(schema).write_parquet(path, compression='uncompressed', statistics=False)
+        keys.append((meter, month))
+    return keys
+
+
+# Sorts the spill files of each (meter_id, month) in keys by ts into one file under dataset_dir / name.
+# Only the rows of one partition are in memory at a time. Returns the partitions in the order of meter_type
+# and month, which is the order of the rows sorted by meter_id and ts
+def write_partitions(spill_dir, keys, empty_df, meter_type, dataset_dir, name):
+    order = {meter: i for i, meter in enumerate(meter_type.categories)}
+    keys = sorted(keys, key=lambda key: (order.get(key[0], len(order)), key[1]))
+
+    partitions = []
+    for meter, month in keys:
+        path = pathlib.Path(name) / f'meter={meter}' / f'month={month}' / 'part-0.parquet'
+        (dataset_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        rows = pl.read_parquet(spill_dir / f'meter={meter}' / f'month={month}').sort('ts')
+        rows.write_parquet(dataset_dir / path)
+        partitions.append({'meter_id': meter, 'month': month, 'part': 0, 'path': str(path), 'rows': rows.height})
+
+    # A dataset without rows still needs a file for its schema
+    if not partitions:
+        path = pathlib.Path(name) / 'empty.parquet'
+        (dataset_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        empty_df.write_parquet(dataset_dir / path)
+        partitions.append({'meter_id': None, 'month': None, 'part': 0, 'path': str(path), 'rows': 0})
+    return partitions
+
+
+# Reads the parquet file one row group at a time and writes the L and Total datasets to dataset_dir in compact dtypes.
+# Hourly rollups are built for each row group and merged at the end, so only one row group is in memory at a time.
+# The rows of each row group are spilled to files by meter_id and month, and each partition is then sorted by ts
+# on its own, so the datasets are sorted by meter_id and ts, which DataAnalyzer's row offsets rely on,
+# without sorting the whole file.
+# progress is called with the number of row groups done and the number of row groups in the file.
+# meter_type is the Enum of meter_id, by default the meters of the file.
+# Returns the partitions, hourly rollups and the in-memory sizes in bytes before and after compacting the dtypes,
+# all by dataset name
+def ingest_parquet(path, dataset_dir, progress=None, meter_type=None):
+    # pyarrow is only imported when a file is processed, not when the app starts
+    import pyarrow.parquet as pq
+
+    dataset_dir = pathlib.Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    parquet_file = pq.ParquetFile(path)
+    total_columns, data_columns = classify_columns(parquet_file.schema_arrow.names)
+    meter_type = meter_type if meter_type is not None else meter_enum(parquet_file)
+
+    # Every row group is spilled with the schemas of an empty batch, so the files of a partition can be read together
+    empty_datasets = empty_dataframes(parquet_file, meter_type)
+    spill_dirs = {name: dataset_dir / f'{name}.spill' for name in empty_datasets}
+    spill_keys = {name: set() for name in empty_datasets}
+    partial_rollups = {name: [] for name in empty_datasets}
+    sizes = {name: [0, 0] for name in empty_datasets}
+    # Latest timestamp of the repeated autumn hour of each meter, kept between the row groups
+    ambiguous_seen = {}
+
+    try:
+        for i in range(parquet_file.num_row_groups):
+            batch = pl.from_arrow(parquet_file.read_row_group(i))
+            for name, df in process_batch(batch, total_columns, data_columns, ambiguous_seen).items():
+                sizes[name][0] += df.estimated_size()
+                df = compact_dtypes(df, meter_type)
+                sizes[name][1] += df.estimated_size()
+                spill_keys[name].update(spill_batch(df, empty_datasets[name].schema, spill_dirs[name], i))
+                partial_rollups[name].append(build_rollup(df.lazy(), '1h'))
+            if progress is not None:
+                progress(i + 1, parquet_file.num_row_groups)
+
+        partitions = {}
+        for name, spill_dir in spill_dirs.items():
+            partitions[name] = write_partitions(spill_dir, spill_keys[name], empty_datasets[name], meter_type,
+                                                dataset_dir, name)
+    finally:
+        for spill_dir in spill_dirs.values():
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # Hours that were split between row groups are merged into one row
+    hourly_rollups = {}
+    for name, rollups in partial_rollups.items():
+        if rollups:
+            hourly_rollups[name] = rollup_from_hourly(pl.concat(rollups).sort(['meter_id', 'ts']), '1h')
+        else:
+            hourly_rollups[name] = build_rollup(empty_datasets[name].lazy(), '1h')
+    return partitions, hourly_rollups, {name: tuple(size) for name, size in sizes.items()}
@@ -0,0 +1,137 @@
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+import streamlit as st
+
+
+# Resident set size of this process in bytes
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Without /proc only the peak of the whole run is known
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# Number of rows and size in bytes of a stage's result: a DataFrame or a tuple of DataFrames and arrays
+def result_shape(result):
+    if hasattr(result, 'estimated_size'):
+        return getattr(result, 'height', None), result.estimated_size()
+    if hasattr(result, 'nbytes'):
+        return len(result), result.nbytes
+    if isinstance(result, (tuple, list)):
+        shapes = [result_shape(item) for item in result]
+        rows = [rows for rows, _ in shapes if rows is not None]
+        return (max(rows) if rows else None), sum(size for _, size in shapes)
+    return None, 0
+
+
+# One timed stage. rows_out and bytes_out are set with output(result)
+class StageRecord:
+    def __init__(self, stage, rows_in=None):
+        self.stage = stage
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_out = None
+        self.seconds = 0.0
+        self.rss_delta = 0
+
+    def output(self, result):
+        self.rows_out, self.bytes_out = result_shape(result)
+        return result
+
+    def as_dict(self):
+        return {'stage': self.stage, 'seconds': self.seconds, 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+                'bytes_out': self.bytes_out, 'rss_delta': self.rss_delta}
+
+
+# Timing of the stages of one rerun. Nested stages are named after their parents, like 'line_chart/downsample'.
+# Stages must be recorded from the script thread, the worker pool only computes results
+class Profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.stack = []
+
+    def reset(self):
+        self.records = []
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = StageRecord('/'.join(self.stack + [name]), rows_in)
+        if not self.enabled:
+            yield record
+            return
+
+        self.stack.append(name)
+        rss = current_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            record.rss_delta = current_rss() - rss
+            self.stack.pop()
+            self.records.append(record)
+
+    def to_json(self):
+        return json.dumps([record.as_dict() for record in self.records], indent=2)
+
+    # Prometheus text exposition format. Stages that ran several times in the rerun are summed
+    def to_prometheus(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record.stage, {'seconds': 0.0, 'calls': 0, 'rows_in': 0, 'rows_out': 0,
+                                                     'bytes_out': 0, 'rss_delta': 0})
+            total['calls'] += 1
+            for metric in ('seconds', 'rows_in', 'rows_out', 'bytes_out', 'rss_delta'):
+                total[metric] += getattr(record, metric) or 0
+
+        metrics = [('seconds', 'Wall time of the stage in seconds'),
+                   ('calls', 'Number of times the stage ran'),
+                   ('rows_in', 'Rows read by the stage'),
+                   ('rows_out', 'Rows returned by the stage'),
+                   ('bytes_out', 'Size of the result of the stage in bytes'),
+                   ('rss_delta', 'Change of the resident set size during the stage in bytes')]
+        lines = []
+        for metric, description in metrics:
+            name = f'streamlit_analyzer_stage_{metric}'
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} gauge')
+            for stage, total in totals.items():
+                lines.append(f'{name}{{stage="{stage}"}} {total[metric]}')
+        return '\n'.join(lines) + '\n'
+
+
+# Records nothing, used when profiling is off
+disabled_profiler = Profiler(enabled=False)
+
+
+# Returns the session's profiler when profiling is turned on in the sidebar
+def session_profiler():
+    if st.session_state.get('profiling') and st.session_state.get('profiler') is not None:
+        return st.session_state.profiler
+    return disabled_profiler
+
+
+# Times a block of code as a stage of the session's profiler
+def stage(name, rows_in=None):
+    return session_profiler().stage(name, rows_in)
+
+
+# Times every call of the decorated function as a stage and records the rows and size of its result
+def profiled(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                return record.output(function(*args, **kwargs))
+        return wrapper
+    return decorator